@@ -0,0 +1,876 @@
+#!/usr/bin/env python3
+
+import gfxmpc
+import argparse
+import asyncio
+import io
+import json
+import multiprocessing
+import os
+import resource
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# MPD's default max_output_buffer_size.
+MAX_OUTPUT_BUFFER = 8 * 1024 * 1024
+IDLE_SUBSYSTEMS = ('database', 'update', 'stored_playlist', 'playlist', 'player', 'mixer', 'output', 'options')
+TIMED_METHODS = (
+        (gfxmpc.Text, 'draw'),
+        (gfxmpc.Text, 'scroll'),
+        (gfxmpc.ProgressBar, 'draw'),
+        (gfxmpc.ProgressBar, 'update'),
+        (gfxmpc.Time, 'draw'),
+        (gfxmpc.Time, 'update'),
+        (gfxmpc.Indicators, 'draw'),
+        (gfxmpc.Spectrum, 'update'),
+        (gfxmpc.Browser, 'draw'),
+        (gfxmpc.QueueView, 'draw'),
+        (gfxmpc.SharedMemoryDisplay, 'show'),
+        (gfxmpc.StatsView, 'draw'),
+        (gfxmpc.History, 'write'),
+        (gfxmpc.History, 'stats'),
+        (gfxmpc.Pages, 'switch'),
+        (gfxmpc.Pages, 'show_overlay')
+)
+
+
+class StubST7567:
+    def __init__(self):
+        self.command_bytes = 0
+        self.data_bytes = 0
+
+    def setup(self):
+        pass
+
+    def _command(self, data):
+        self.command_bytes += len(data)
+
+    def _data(self, data):
+        self.data_bytes += len(data)
+
+
+class StubLCD:
+    def __init__(self):
+        self.st7567 = StubST7567()
+
+    def clear(self):
+        pass
+
+    def show(self):
+        pass
+
+
+class StubBacklight:
+    def __init__(self):
+        self.color = None
+        self.shows = 0
+
+    def set_all(self, r, g, b):
+        self.color = (r, g, b)
+
+    def show(self):
+        self.shows += 1
+
+
+class StubTouch:
+    def __init__(self):
+        self._cap1166 = None
+        self.handlers = {}
+        self.leds = [0] * 6
+
+    def enable_repeat(self, enable):
+        pass
+
+    def on(self, channel, handler=None):
+        self.handlers[channel] = handler
+
+    def set_led(self, channel, state):
+        self.leds[channel] = state
+
+
+class FakeClient:
+    def __init__(self, reader):
+        self.pending = set()
+        self.event = asyncio.Event()
+        self._reader = reader
+        self._line = None
+
+    def next_line(self):
+        # The pending read survives an idle that ends on a change, so a
+        # late noidle is read by the command loop rather than lost.
+        if self._line is None:
+            self._line = asyncio.ensure_future(self._reader.readline())
+        return self._line
+
+    async def readline(self):
+        line = await self.next_line()
+        self._line = None
+        return line
+
+
+class FakeMPD:
+    # Just enough of MPD for gfxmpc: playback state, a queue taken from the
+    # front of the database, the idle/noidle handshake, command lists,
+    # chunked album art and database listings. Like MPD, it drops a client
+    # whose response outgrows the output buffer.
+    def __init__(self, library, queue_length, clock=time.monotonic, max_output=MAX_OUTPUT_BUFFER):
+        self.clock = clock
+        self.max_output = max_output
+        self.library = {song['file']: song for song in library}
+        self.songs = [dict(song, Pos=str(i), Id=str(i + 1)) for i, song in enumerate(library[:queue_length])]
+        self.db_update = int(time.time()) - 3600
+        self._mtimes = dict.fromkeys(self.library, self.db_update - 3600)
+        self._next_id = len(self.songs) + 1
+        self.version = 1
+        self._versions = [self.version] * len(self.songs)
+        self.binary_limit = 8192
+        self._covers = {}
+        self.pos = 0
+        self.state = 'stop'
+        self.volume = 50
+        self.options = {'repeat': '0', 'random': '0', 'single': '0', 'consume': '0'}
+        self._elapsed = 0.0
+        self._t_start = 0.0
+        self._clients = []
+
+    def changed(self, *subsystems):
+        for client in self._clients:
+            client.pending.update(subsystems)
+            client.event.set()
+
+    def elapsed(self):
+        if self.state == 'play':
+            return self._elapsed + self.clock() - self._t_start
+        return self._elapsed
+
+    def play(self, pos=None, elapsed=0.0):
+        if pos is not None:
+            self.pos = pos % len(self.songs)
+        self.state = 'play'
+        self._elapsed = elapsed
+        self._t_start = self.clock()
+        self.changed('player')
+
+    def pause(self):
+        if self.state == 'play':
+            self._elapsed = self.elapsed()
+            self.state = 'pause'
+        elif self.state == 'pause':
+            self.state = 'play'
+            self._t_start = self.clock()
+        self.changed('player')
+
+    def stop(self):
+        self.state = 'stop'
+        self._elapsed = 0.0
+        self.changed('player')
+
+    def retag(self, uri):
+        # A tag edit picked up by a database update.
+        song = self.library[uri]
+        song['Title'] = song['Title'].rpartition(' (')[0] or song['Title']
+        song['Title'] += ' (%d)' % self.db_update
+        self.db_update = int(time.time()) + 1
+        self._mtimes[uri] = self.db_update
+        self.changed('database')
+
+    def renumber(self, start):
+        # Every position from start on now holds a different song.
+        self.version += 1
+        del self._versions[start:]
+        for i in range(start, len(self.songs)):
+            self.songs[i]['Pos'] = str(i)
+            self._versions.append(self.version)
+        self.changed('playlist')
+
+    def add(self, uri):
+        if uri not in self.library:
+            raise LookupError('No such directory')
+        song = dict(self.library[uri], Pos=str(len(self.songs)), Id=str(self._next_id))
+        self._next_id += 1
+        self.songs.append(song)
+        self.renumber(len(self.songs) - 1)
+        return song['Id']
+
+    def delete(self, pos):
+        del self.songs[pos]
+        if pos < self.pos:
+            self.pos -= 1
+        self.renumber(pos)
+
+    def setvol(self, volume):
+        self.volume = max(0, min(100, volume))
+        self.changed('mixer')
+
+    def status(self):
+        pairs = [('volume', str(self.volume))]
+        pairs.extend(self.options.items())
+        pairs.extend([('playlist', str(self.version)), ('playlistlength', str(len(self.songs))), ('state', self.state)])
+        if self.state != 'stop':
+            song = self.songs[self.pos]
+            pairs.extend([('song', str(self.pos)), ('songid', song['Id'])])
+            pairs.extend([('elapsed', '%.3f' % self.elapsed()), ('duration', song['duration'])])
+            if self.pos + 1 < len(self.songs):
+                pairs.extend([('nextsong', str(self.pos + 1)), ('nextsongid', self.songs[self.pos + 1]['Id'])])
+        return pairs
+
+    def execute(self, name, args):
+        if name == 'status':
+            return self.status()
+        if name == 'currentsong':
+            if self.state == 'stop':
+                return []
+            return list(self.songs[self.pos].items())
+        if name == 'playlistid':
+            for song in self.songs:
+                if song['Id'] == args[0]:
+                    return list(song.items())
+            raise LookupError('No such song')
+        if name == 'ping':
+            return []
+        if name == 'playlistinfo':
+            start, _, end = args[0].partition(':')
+            return [pair for song in self.songs[int(start):int(end or int(start) + 1)] for pair in song.items()]
+        if name == 'plchangesposid':
+            start, end = map(int, args[1].split(':')) if len(args) > 1 else (0, len(self.songs))
+            version = int(args[0])
+            return [pair for i in range(start, min(end, len(self.songs))) if self._versions[i] > version
+                    for pair in (('cpos', str(i)), ('Id', self.songs[i]['Id']))]
+        if name == 'stats':
+            return [('songs', str(len(self.library))), ('db_update', str(self.db_update))]
+        if name == 'listallinfo':
+            return [pair for song in self.library.values() for pair in song.items()]
+        if name == 'listall':
+            return [('file', uri) for uri in self.library]
+        if name == 'lsinfo':
+            if args[0] not in self.library:
+                raise LookupError('No such directory')
+            return list(self.library[args[0]].items())
+        if name == 'find':
+            since = int(args[0].split('"')[1])
+            songs = [song for uri, song in self.library.items() if self._mtimes[uri] > since]
+            if args[1:2] == ['window']:
+                start, end = map(int, args[2].split(':'))
+                songs = songs[start:end]
+            return [pair for song in songs for pair in song.items()]
+        if name == 'add':
+            self.add(args[0])
+            return []
+        if name == 'addid':
+            return [('Id', self.add(args[0]))]
+        if name == 'binarylimit':
+            self.binary_limit = int(args[0])
+            return []
+        if name == 'readpicture':
+            return []
+        if name == 'albumart':
+            cover = self.cover(os.path.dirname(args[0]))
+            offset = int(args[1])
+            return [('size', str(len(cover))), ('binary', cover[offset:offset + self.binary_limit])]
+        if name == 'play':
+            self.play(int(args[0]) if args else None)
+        elif name == 'next':
+            self.play(self.pos + 1)
+        elif name == 'previous':
+            self.play(self.pos - 1)
+        elif name == 'playid':
+            self.play([song['Id'] for song in self.songs].index(args[0]))
+        elif name == 'pause':
+            self.pause()
+        elif name == 'stop':
+            self.stop()
+        elif name == 'seekcur':
+            t = float(args[0])
+            if args[0][0] in '+-':
+                t += self.elapsed()
+            self.play(elapsed=max(t, 0.0))
+        elif name == 'setvol':
+            self.setvol(int(args[0]))
+        elif name == 'volume':
+            self.setvol(self.volume + int(args[0]))
+        elif name == 'delete':
+            self.delete(int(args[0]))
+        else:
+            raise LookupError('unknown command "%s"' % name)
+        return []
+
+    def cover(self, directory):
+        # A 500x500 JPEG per album, drawn on first request; every third
+        # album has none.
+        if directory not in self._covers:
+            album = sum(directory.encode('utf-8'))
+            if album % 3 == 0:
+                raise LookupError('No file exists')
+            from PIL import Image, ImageDraw
+            image = Image.linear_gradient('L').resize((500, 500)).rotate(album % 360).convert('RGB')
+            draw = ImageDraw.Draw(image)
+            draw.ellipse((100 + album % 50, 120, 380, 400), fill=(album % 256, 40, 200))
+            f = io.BytesIO()
+            image.save(f, 'JPEG', quality=85)
+            self._covers[directory] = f.getvalue()
+        return self._covers[directory]
+
+    def respond(self, name, args, listed=False):
+        try:
+            pairs = self.execute(name, args)
+        except LookupError as e:
+            return ('ACK [50@0] {%s} %s\n' % (name, e.args[0])).encode('utf-8'), False
+        body = []
+        for key, value in pairs:
+            if isinstance(value, bytes):
+                body.append(b'binary: %d\n' % len(value) + value + b'\n')
+            else:
+                body.append(('%s: %s\n' % (key, value)).encode('utf-8'))
+        body.append(b'list_OK\n' if listed else b'OK\n')
+        return b''.join(body), True
+
+    async def _idle(self, client, subsystems):
+        subsystems = set(subsystems or IDLE_SUBSYSTEMS)
+        line = client.next_line()
+        while True:
+            changed = client.pending & subsystems
+            if changed or line.done():
+                break
+            client.event.clear()
+            waiter = asyncio.ensure_future(client.event.wait())
+            await asyncio.wait([line, waiter], return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+        if line.done():
+            data = await client.readline()
+            if not data:
+                return None
+            if data.strip() != b'noidle':
+                raise ConnectionError('command sent during idle')
+        client.pending -= changed
+        return sorted(changed)
+
+    async def handle(self, reader, writer):
+        client = FakeClient(reader)
+        self._clients.append(client)
+        writer.write(b'OK MPD 0.23.5\n')
+        try:
+            while True:
+                line = await client.readline()
+                if not line:
+                    break
+                args = shlex.split(line.decode('utf-8'))
+                if not args:
+                    continue
+                name = args.pop(0)
+                if name == 'noidle':
+                    continue
+                if name == 'close':
+                    break
+                if name == 'idle':
+                    changed = await self._idle(client, args)
+                    if changed is None:
+                        break
+                    response = ''.join('changed: %s\n' % s for s in changed).encode('utf-8') + b'OK\n'
+                elif name == 'command_list_ok_begin':
+                    commands = []
+                    while True:
+                        listed = shlex.split((await client.readline()).decode('utf-8'))
+                        if listed == ['command_list_end']:
+                            break
+                        commands.append(listed)
+                    response = b''
+                    for listed in commands:
+                        body, ok = self.respond(listed[0], listed[1:], listed=True)
+                        response += body
+                        if not ok:
+                            break
+                    else:
+                        response += b'OK\n'
+                else:
+                    response, _ = self.respond(name, args)
+                if len(response) > self.max_output:
+                    break
+                writer.write(response)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self._clients.remove(client)
+            writer.close()
+
+
+def make_songs(count, duration):
+    songs = []
+    for i in range(count):
+        songs.append({
+                'file': 'Artist %d/Album %d/%02d.flac' % (i // 20, i // 10, i % 10 + 1),
+                'Title': 'Symphony No. %d in D minor, Op. %d: II. Adagio molto e cantabile' % (i % 9 + 1, 100 + i),
+                'Artist': 'Berliner Philharmoniker %d' % (i // 20),
+                'Album': 'Complete Symphonies, Volume %d' % (i // 10),
+                'Track': str(i % 10 + 1),
+                'duration': '%.3f' % duration
+        })
+    return songs
+
+
+def make_history(path, count, songs):
+    # Plays spread over the past year, as if the queue had been played
+    # over and over.
+    history = gfxmpc.History(path)
+    t = time.time() - 365 * 86400
+    batch = []
+    for i in range(count):
+        song = {key.lower(): value for key, value in songs[i % len(songs)].items()}
+        batch.append((t + i * 365 * 86400 / count, song['file'], song['artist'], song['album'], song['title'], float(song['duration'])))
+    history.write(batch)
+    history.close()
+
+
+async def script(mpd, track_length, retag, edit):
+    await asyncio.sleep(0.5)
+    mpd.play(0)
+    while True:
+        await asyncio.sleep(track_length / 2)
+        mpd.setvol(mpd.volume + 5 if mpd.volume < 90 else 10)
+        if edit:
+            # Another client drops the song after next and queues one.
+            mpd.delete(min(mpd.pos + 2, len(mpd.songs) - 1))
+            mpd.add(mpd.songs[0]['file'])
+        await asyncio.sleep(track_length / 2)
+        mpd.play(mpd.pos + 1)
+        if retag:
+            mpd.retag(mpd.songs[mpd.pos]['file'])
+
+
+def serve(path, track_length, songs, library, retag, edit):
+    async def main():
+        mpd = FakeMPD(make_songs(max(songs, library), track_length), songs)
+        server = await asyncio.start_unix_server(mpd.handle, path)
+        async with server:
+            await script(mpd, track_length, retag, edit)
+
+    asyncio.run(main())
+
+
+def press_buttons(touch, interval, stop):
+    # Stands in for the cap1xxx polling thread: taps the seek buttons in
+    # quick succession, then holds one down.
+    def press(channel, hold):
+        touch.handlers[channel](channel, 'press')
+        stop.wait(hold)
+        touch.handlers[channel](channel, 'release')
+        stop.wait(0.05)
+
+    while not stop.wait(interval):
+        press(5, 0.1)
+        press(3, 0.1)
+        press(5, 0.1)
+        press(5, 3)
+
+
+def browse(touch, interval, stop):
+    # Walks the library: down a few rows, a letter jump, into an album and
+    # back out again.
+    def tap(channel):
+        touch.handlers[channel](channel, 'press')
+        stop.wait(0.05)
+        touch.handlers[channel](channel, 'release')
+        stop.wait(0.1)
+
+    while not stop.wait(interval):
+        for channel in (1, 1, 5, 4, 1, 4, 1, 2, 2, 3, 0):
+            tap(channel)
+
+
+def cycle_screens(touch, interval, stop):
+    # Holds back long enough to move on to the next screen.
+    while not stop.wait(interval):
+        touch.handlers[gfxmpc.TOUCH_SCREEN](gfxmpc.TOUCH_SCREEN, 'press')
+        stop.wait(gfxmpc.TOUCH_HOLD_DELAY + 0.1)
+        touch.handlers[gfxmpc.TOUCH_SCREEN](gfxmpc.TOUCH_SCREEN, 'release')
+
+
+def mirror(path, stop, seen):
+    # A local consumer of the shared-memory frame, polling the sequence
+    # counter every millisecond.
+    reader = gfxmpc.SharedMemoryReader(path)
+    seq = None
+    while not stop.wait(0.001):
+        seq, frame = reader.read(seq)
+        if frame is not None:
+            seen[0] += 1
+    reader.close()
+
+
+def feed_fifo(path, stop):
+    # Stands in for MPD's fifo output: a tone sweeping 100 Hz - 10 kHz over
+    # a steady 440 Hz one, written in 20 ms chunks and dropped when the
+    # pipe is full.
+    import numpy
+    fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+    chunk = gfxmpc.SPECTRUM_RATE // 50
+    n = 0
+    while not stop.wait(0.02):
+        t = (n + numpy.arange(chunk)) / gfxmpc.SPECTRUM_RATE
+        phase = 2 * numpy.pi * 100 * 5 / numpy.log(100) * 100 ** ((t / 5) % 1)
+        mono = 8000 * numpy.sin(phase) + 4000 * numpy.sin(2 * numpy.pi * 440 * t)
+        n += chunk
+        try:
+            os.write(fd, numpy.repeat(mono.astype('<i2'), 2).tobytes())
+        except BlockingIOError:
+            pass
+    os.close(fd)
+
+
+def instrument():
+    totals = {}
+
+    def timed(cls, name):
+        method = getattr(cls, name)
+        entry = totals.setdefault(cls.__name__ + '.' + name, [0, 0.0])
+
+        def wrapper(*args, **kwargs):
+            t = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                entry[0] += 1
+                entry[1] += time.perf_counter() - t
+        setattr(cls, name, wrapper)
+
+    for cls, name in TIMED_METHODS:
+        timed(cls, name)
+    return totals
+
+
+def count_wakeups(loop):
+    # Every select() that is allowed to block ends in one wakeup of the
+    # process, whether a timer or a socket caused it.
+    selector = loop._selector
+    select = selector.select
+    wakeups = [0]
+
+    def wrapper(timeout=None):
+        if timeout is None or timeout > 0:
+            wakeups[0] += 1
+        return select(timeout)
+    selector.select = wrapper
+    return wakeups
+
+
+def rss_kb():
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+def percentile(values, q):
+    # Nearest rank of sorted values.
+    if not values:
+        return None
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def first_frame(args):
+    # Runs in a fresh interpreter started by cold_start(): prints the time
+    # the first pixel data reaches the display, then exits.
+    def report(data):
+        print(time.time(), flush=True)
+        os._exit(0)
+
+    lcd = StubLCD()
+    lcd.st7567._data = report
+    gfxmpc.lcd = lcd
+    gfxmpc.backlight = StubBacklight()
+    gfxmpc.touch = StubTouch()
+    host = os.path.join(os.path.dirname(args.atlas), 'no-mpd.socket')
+    gfxmpc.MPC(gfxmpc.GfxHatDisplay(), host=host, font_path=args.font, atlas_path=args.atlas).start()
+
+
+def cold_start(args, atlas):
+    # Wall time from spawning the interpreter to the first frame.
+    command = [sys.executable, os.path.abspath(__file__), '--first-frame', '--font', args.font, '--atlas', atlas]
+    t = time.time()
+    out = subprocess.run(command, stdout=subprocess.PIPE, check=True).stdout
+    return float(out) - t
+
+
+async def measure(args, path, atlas):
+    lcd = StubLCD()
+    gfxmpc.lcd = lcd
+    gfxmpc.backlight = StubBacklight()
+    gfxmpc.touch = StubTouch()
+    totals = instrument()
+    wakeups = count_wakeups(asyncio.get_running_loop())
+
+    stop = threading.Event()
+    fifo = None
+    if args.spectrum:
+        fifo = os.path.join(os.path.dirname(path), 'mpd.fifo')
+        os.mkfifo(fifo)
+        threading.Thread(target=feed_fifo, args=(fifo, stop), daemon=True).start()
+
+    display = gfxmpc.GfxHatDisplay()
+    shm = None
+    mirrored = [0]
+    if args.shm:
+        # The headless display keeps a copy of what the panel was sent, to
+        # compare the shared frame against.
+        panel = gfxmpc.HeadlessDisplay()
+        shm = gfxmpc.SharedMemoryDisplay(os.path.join(os.path.dirname(path), 'frame'))
+        display = gfxmpc.MultiDisplay(display, shm, panel)
+        threading.Thread(target=mirror, args=(shm.path, stop, mirrored), daemon=True).start()
+    art_cache_dir = os.path.join(os.path.dirname(path), 'art')
+    library_path = os.path.join(os.path.dirname(path), 'library.index')
+    history_path = os.path.join(os.path.dirname(path), 'history.db')
+    if args.history:
+        make_history(history_path, args.history, make_songs(args.songs, args.track_length))
+    mpc = gfxmpc.MPC(display, fps=args.fps, host=path, font_path=args.font, atlas_path=atlas, fifo_path=fifo, art_cache_dir=art_cache_dir,
+            library_path=library_path, history_path=history_path)
+    task = asyncio.create_task(mpc.run())
+
+    syncs = []
+    sync_library = mpc._sync_library
+
+    async def timed_sync():
+        t = time.perf_counter()
+        await sync_library()
+        syncs.append(time.perf_counter() - t)
+    mpc._sync_library = timed_sync
+
+    refreshes = []
+    rows = [0]
+    refresh_queue = mpc._refresh_queue
+    set_rows = gfxmpc.QueueView.set_rows
+
+    async def timed_refresh():
+        t = time.perf_counter()
+        await refresh_queue()
+        refreshes.append(time.perf_counter() - t)
+
+    def counted_rows(view, songs):
+        rows[0] += len(songs)
+        set_rows(view, songs)
+    mpc._refresh_queue = timed_refresh
+    gfxmpc.QueueView.set_rows = counted_rows
+
+    fetches = []
+    lookups = [0, 0]
+    if args.art:
+        fetch_art = mpc._fetch_art
+        get = mpc._art_cache.get
+
+        async def timed_fetch(*a):
+            t = time.perf_counter()
+            data = await fetch_art(*a)
+            fetches.append(time.perf_counter() - t)
+            return data
+
+        def counted_get(key):
+            data = get(key)
+            lookups[data is None] += 1
+            return data
+        mpc._fetch_art = timed_fetch
+        mpc._art_cache.get = counted_get
+
+    inputs = [0, 0]
+    if args.touch:
+        press = mpc._press
+        command = mpc._mpd.command
+
+        def counted_press(*a):
+            inputs[0] += 1
+            press(*a)
+
+        async def counted_command(name, *a):
+            if name == 'seekcur':
+                inputs[1] += 1
+            return await command(name, *a)
+        mpc._press = counted_press
+        mpc._mpd.command = counted_command
+        threading.Thread(target=press_buttons, args=(gfxmpc.touch, args.track_length / 2, stop), daemon=True).start()
+    if args.spectrum:
+        await asyncio.sleep(1)
+        mpc._set_screen('spectrum')
+    elif args.art:
+        await asyncio.sleep(1)
+        mpc._set_screen('art')
+    elif args.browse:
+        await asyncio.sleep(1)
+        mpc._set_screen('library')
+        threading.Thread(target=browse, args=(gfxmpc.touch, 1, stop), daemon=True).start()
+    elif args.queue:
+        await asyncio.sleep(1)
+        mpc._set_screen('queue')
+    elif args.stats:
+        await asyncio.sleep(1)
+        mpc._set_screen('stats')
+    elif args.cycle:
+        threading.Thread(target=cycle_screens, args=(gfxmpc.touch, args.cycle, stop), daemon=True).start()
+
+    cpu = time.process_time()
+    t = time.monotonic()
+    woken = wakeups[0]
+    timers = mpc._scheduler.wakeups.total
+    await asyncio.sleep(args.duration)
+    woken = wakeups[0] - woken
+    timers = mpc._scheduler.wakeups.total - timers
+    cpu = time.process_time() - cpu
+    wall = time.monotonic() - t
+
+    stop.set()
+    compositor = mpc._compositor.stats()
+    latency = list(mpc.track_change_latency)
+    event_round_trips = sorted(cost[0] for cost in mpc.event_cost)
+    event_socket_time = sorted(cost[1] for cost in mpc.event_cost)
+    touch_latency = list(mpc.touch_latency)
+    result = {
+            'duration': wall,
+            'fps': args.fps,
+            'widgets': {
+                    key: {'calls': calls, 'total_s': total, 'mean_us': total / calls * 1e6 if calls else 0.0}
+                    for key, (calls, total) in totals.items()
+            },
+            'display': {
+                    'flushes': compositor['flushes'],
+                    'flushes_per_second': compositor['flushes'] / wall,
+                    'bytes': display.pushed.total,
+                    'bytes_per_second': display.pushed.total / wall,
+                    'spi_command_bytes': lcd.st7567.command_bytes,
+                    'spi_data_bytes': lcd.st7567.data_bytes,
+                    'frame_time_avg_s': compositor['frame_time_avg'],
+                    'frame_time_max_s': compositor['frame_time_max']
+            },
+            'track_change_latency': {
+                    'samples': len(latency),
+                    'mean_s': sum(latency) / len(latency) if latency else None,
+                    'max_s': max(latency) if latency else None
+            },
+            'spectrum': {
+                    'frames_dropped': mpc._spectrum.dropped
+            } if args.spectrum else None,
+            'art': {
+                    'cache_hits': lookups[0],
+                    'cache_misses': lookups[1],
+                    'fetches': len(fetches),
+                    'fetch_mean_s': sum(fetches) / len(fetches) if fetches else None,
+                    'fetch_max_s': max(fetches) if fetches else None
+            } if args.art else None,
+            'shm': {
+                    'frames': shm.frames,
+                    'bytes': shm.pushed.total,
+                    'frames_mirrored': mirrored[0],
+                    'matches_panel': gfxmpc.SharedMemoryReader(shm.path).read()[1] == panel.buf
+            } if args.shm else None,
+            'queue': {
+                    'refreshes': len(refreshes),
+                    'refresh_mean_s': sum(refreshes) / len(refreshes) if refreshes else None,
+                    'rows_fetched': rows[0]
+            } if args.queue else None,
+            'history': {
+                    'db_bytes': sum(os.path.getsize(history_path + suffix) for suffix in ('', '-wal') if os.path.exists(history_path + suffix))
+            },
+            'library': {
+                    'songs': len(mpc._library),
+                    'syncs': len(syncs),
+                    'first_sync_s': syncs[0] if syncs else None,
+                    'sync_failed': mpc._browser.failed,
+                    'later_sync_mean_s': sum(syncs[1:]) / (len(syncs) - 1) if len(syncs) > 1 else None,
+                    'index_bytes': os.path.getsize(library_path) if os.path.exists(library_path) else 0
+            },
+            'touch': {
+                    'seek_inputs': inputs[0],
+                    'seek_commands': inputs[1],
+                    'samples': len(touch_latency),
+                    'mean_s': sum(touch_latency) / len(touch_latency) if touch_latency else None,
+                    'max_s': max(touch_latency) if touch_latency else None
+            },
+            'cpu': {
+                    'seconds': cpu,
+                    'seconds_per_playback_hour': cpu / wall * 3600,
+                    'wakeups_per_minute': woken / wall * 60,
+                    'timer_wakeups_per_minute': timers / wall * 60
+            },
+            'rss': {
+                    'current_kb': rss_kb(),
+                    'peak_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            },
+            'mpd': {
+                    'round_trips': mpc._mpd.round_trips,
+                    'socket_time_s': mpc._mpd.socket_time,
+                    'events': len(event_round_trips),
+                    'event_round_trips_p50': percentile(event_round_trips, 0.5),
+                    'event_round_trips_p95': percentile(event_round_trips, 0.95),
+                    'event_socket_time_p50_s': percentile(event_socket_time, 0.5),
+                    'event_socket_time_p95_s': percentile(event_socket_time, 0.95)
+            },
+            'text_cache': gfxmpc.text_cache.stats()
+    }
+
+    task.cancel()
+    await task
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark gfxmpc headless against a scripted fake MPD server.')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to measure')
+    parser.add_argument('--track-length', type=float, default=10, help='seconds per scripted track')
+    parser.add_argument('--songs', type=int, default=50, help='length of the fake queue')
+    parser.add_argument('--library', type=int, default=0, help='songs in the fake database, at least the queue')
+    parser.add_argument('--queue', action='store_true', help='show the queue screen while another client edits the queue on every track')
+    parser.add_argument('--browse', action='store_true', help='walk the library screen and retag a song on every track change')
+    parser.add_argument('--stats', action='store_true', help='show the stats screen, which writes every play as it starts')
+    parser.add_argument('--cycle', type=float, default=0, help='move on to the next screen every this many seconds')
+    parser.add_argument('--history', type=int, default=0, help='plays already in the history when the client starts')
+    parser.add_argument('--spectrum', action='store_true', help='show the spectrum screen, fed a synthetic signal through a fifo')
+    parser.add_argument('--art', action='store_true', help='show the album art screen, with covers served by the fake server')
+    parser.add_argument('--shm', action='store_true', help='also publish frames to shared memory, read back by a polling mirror')
+    parser.add_argument('--touch', action='store_true', help='tap and hold the seek buttons from a background thread')
+    parser.add_argument('--fps', type=int, default=gfxmpc.FRAME_RATE, help='compositor frame rate cap')
+    parser.add_argument('--font', default=gfxmpc.FONT_PATH, help='font used for the text lines')
+    parser.add_argument('--atlas', help='glyph atlas to use; a fresh one is built in a temporary directory by default')
+    parser.add_argument('--cold-start', action='store_true', help='also measure time to first frame with and without a prebuilt atlas')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--first-frame', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.first_frame:
+        first_frame(args)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        atlas = args.atlas or os.path.join(tmp, 'font.atlas')
+        startup = None
+        if args.cold_start:
+            if os.path.exists(atlas):
+                os.unlink(atlas)
+            startup = {
+                    'first_frame_building_atlas_s': cold_start(args, atlas),
+                    'first_frame_s': cold_start(args, atlas)
+            }
+        else:
+            gfxmpc.GlyphAtlas.open(args.font, atlas)
+
+        path = os.path.join(tmp, 'mpd.socket')
+        server = multiprocessing.Process(target=serve, args=(path, args.track_length, args.songs, args.library, args.browse, args.queue), daemon=True)
+        server.start()
+        while not os.path.exists(path):
+            time.sleep(0.01)
+        try:
+            result = asyncio.run(measure(args, path, atlas))
+        finally:
+            server.terminate()
+            server.join()
+        if startup is not None:
+            result['cold_start'] = startup
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
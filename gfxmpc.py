@@ -1,23 +1,109 @@
 #!/usr/bin/env python3
 
-from gfxhat import backlight, lcd, touch
-from mpd import CommandError, MPDClient
-from PIL import Image, ImageDraw, ImageFont
+try:
+    from gfxhat import backlight, lcd, touch
+except ImportError:
+    backlight = lcd = touch = None
+import asyncio
+import bisect
+import collections
+import hashlib
+import heapq
+import importlib.util
+import io
+import mmap
 import os
-import sched
+import re
 import signal
+import sqlite3
+import struct
 import threading
 import time
+import zlib
 
 WIDTH = 128
 HEIGHT = 64
 BACKLIGHT_OFF = (0, 0, 0)
 BACKLIGHT_COLOR = (0, 255, 255)
 BACKLIGHT_TIMEOUT = 10
+VOLUME_TIMEOUT = 2
+FRAME_RATE = 20
+RECONNECT_DELAY = 0.5
+RECONNECT_DELAY_MAX = 30
+SCROLL_DELAY = 1.5
+SCROLL_INTERVAL = 0.1
+TIMER_SLACK = 0.05
+LOW_POWER_INTERVAL = 10
+TOUCH_DEBOUNCE = 0.05
+TOUCH_HOLD_DELAY = 0.5
+TOUCH_REPEAT_INTERVAL = 0.2
+TOUCH_COMMANDS = ('previous', 'next', 'stop', 'seekcur', 'pause', 'seekcur')
+TOUCH_SEEK_DIRECTION = (0, 0, 0, -1, 0, 1)
+TOUCH_SCREEN = 2
+TOUCH_UP = 0
+TOUCH_DOWN = 1
+TOUCH_SELECT = 4
+SEEK_STEP = 5
+SEEK_STEP_MAX = 60
+SEEK_ACCELERATE = 5
+SPECTRUM_Y = 32
+SPECTRUM_HEIGHT = 24
+SPECTRUM_FPS = 20
+SPECTRUM_CPU_BUDGET = 0.1
+SPECTRUM_RATE = 44100
+SPECTRUM_FFT_SIZE = 1024
+SPECTRUM_WINDOWS = 3
+SPECTRUM_RING = 4096
+SPECTRUM_MIN_FREQ = 50
+SPECTRUM_FLOOR_DB = -60
+SPECTRUM_FALL = 2
+SPECTRUM_READ_SIZE = 65536
+ART_HEIGHT = 48
+ART_CACHE_DIR = os.path.join(os.path.dirname(__file__), 'art')
+ART_CACHE_SIZE = 1024 * 1024
+ART_BINARY_LIMIT = 64 * 1024
+LIBRARY_PATH = os.path.join(os.path.dirname(__file__), 'library.index')
+LIBRARY_MAGIC = b'GFXL'
+LIBRARY_VERSION = 1
+LIBRARY_HEADER = struct.Struct('<4sHq')
+LIBRARY_PAGE = 5000
+HISTORY_PATH = os.path.join(os.path.dirname(__file__), 'history.db')
+HISTORY_FLUSH_DELAY = 300
+HISTORY_ROWS = 50
+LYRICS_CACHE_SIZE = 32
+LIST_ROWS = 3
+FONT_PATH = os.path.join(os.path.dirname(__file__), 'unifont-14.0.01.pcf')
 FONT_SIZE = 16
+ATLAS_PATH = os.path.join(os.path.dirname(__file__), 'unifont-14.0.01.atlas')
+ATLAS_MAGIC = b'GFXA'
+ATLAS_VERSION = 2
+ATLAS_HEADER = struct.Struct('<4sHHqq')
+ATLAS_SIZE = 0x10000
+GLYPH_WIDTH = 16
+REPLACEMENT_CHAR = 0xfffd
+SHM_PATH = '/dev/shm/gfxmpc'
+SHM_MAGIC = b'GFXF'
+SHM_VERSION = 1
+SHM_HEADER = struct.Struct('<4sHHH6xQ')
+SHM_SEQUENCE = struct.Struct('<Q')
+TEXT_STRIP_LIMIT = 2048
+TEXT_CACHE_SIZE = 64 * 1024
+LATENCY_SAMPLES = 64
+LATENCY_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 1)
+BYTE_BUCKETS = (16, 32, 64, 128, 256, 512, 1024)
+ROUND_TRIP_BUCKETS = (0, 1, 2, 3, 4, 6, 8)
+MPD_SOCKET = '/var/run/mpd/socket'
+MPD_PORT = 6600
+IDLE_SUBSYSTEMS = ('player', 'mixer', 'options', 'playlist', 'database')
 BAR_SIZE = 5
 NUM_CHAR_WIDTH = 6
 NUM_CHAR_HEIGHT = 7
+ST7567_SETCOLL = 0x00
+ST7567_SETCOLH = 0x10
+ST7567_SETPAGESTART = 0xb0
+ST7567_ENTER_RMWMODE = 0xe0
+ST7567_EXIT_RMWMODE = 0xee
+ST7567_ADDRESS_BYTES = 3
 NUM_CHAR = (
         # 0
         (
@@ -129,39 +215,820 @@ NUM_CHAR = (
             (0, 1, 1, 0, 0)
         ),
 )
+LETTER_CHAR = {
+        'C': (
+            (0, 1, 1, 1, 0),
+            (1, 0, 0, 0, 1),
+            (1, 0, 0, 0, 0),
+            (1, 0, 0, 0, 0),
+            (1, 0, 0, 0, 0),
+            (1, 0, 0, 0, 1),
+            (0, 1, 1, 1, 0)
+        ),
+
+        'R': (
+            (1, 1, 1, 1, 0),
+            (1, 0, 0, 0, 1),
+            (1, 0, 0, 0, 1),
+            (1, 1, 1, 1, 0),
+            (1, 0, 1, 0, 0),
+            (1, 0, 0, 1, 0),
+            (1, 0, 0, 0, 1)
+        ),
+
+        'S': (
+            (0, 1, 1, 1, 1),
+            (1, 0, 0, 0, 0),
+            (1, 0, 0, 0, 0),
+            (0, 1, 1, 1, 0),
+            (0, 0, 0, 0, 1),
+            (0, 0, 0, 0, 1),
+            (1, 1, 1, 1, 0)
+        ),
+
+        'Z': (
+            (1, 1, 1, 1, 1),
+            (0, 0, 0, 0, 1),
+            (0, 0, 0, 1, 0),
+            (0, 0, 1, 0, 0),
+            (0, 1, 0, 0, 0),
+            (1, 0, 0, 0, 0),
+            (1, 1, 1, 1, 1)
+        ),
+}
+
+_REVERSE_BITS = bytes(int('{:08b}'.format(b)[::-1], 2) for b in range(256))
+_SHIFT_UP = [bytes((b << s) & 0xff for b in range(256)) for s in range(8)]
+_SHIFT_DOWN = [bytes(b >> (8 - s) for b in range(256)) for s in range(8)]
+_INVERT_BITS = bytes(255 - b for b in range(256))
+
+
+class Bitmap:
+    # Column-packed 1-bit image in the ST7567 page layout: pages[k][x] holds
+    # rows 8k..8k+7 of column x, LSB on top.
+    def __init__(self, width, height, pages=None):
+        self.width = width
+        self.height = height
+        if pages is None:
+            pages = [bytes(width) for _ in range((height + 7) // 8)]
+        self.pages = pages
+
+    @classmethod
+    def from_rows(cls, rows):
+        height = len(rows)
+        width = len(rows[0])
+        pages = []
+        for k in range(0, height, 8):
+            band = rows[k:k + 8]
+            pages.append(bytes(sum(row[x] << j for j, row in enumerate(band)) for x in range(width)))
+        return cls(width, height, pages)
+
+    @classmethod
+    def from_image(cls, image):
+        from PIL import Image
+        w, h = image.size
+        stride = (h + 7) // 8
+        data = image.transpose(Image.TRANSPOSE).tobytes()
+        pages = [data[k::stride].translate(_REVERSE_BITS) for k in range(stride)]
+        return cls(w, h, pages)
+
+
+NUM_BITMAP = [Bitmap.from_rows(c) for c in NUM_CHAR]
+COLON_BITMAP = Bitmap.from_rows(((0,), (1,), (0,), (0,), (0,), (1,), (0,)))
+LETTER_BITMAP = {c: Bitmap.from_rows(rows) for c, rows in LETTER_CHAR.items()}
+BLANK_BITMAP = Bitmap(NUM_CHAR_WIDTH - 1, NUM_CHAR_HEIGHT)
+
+
+class RateCounter:
+    def __init__(self):
+        self.total = 0
+        self._mark_total = 0
+        self._mark_time = time.monotonic()
+
+    def add(self, n):
+        self.total += n
+
+    def rate(self):
+        now = time.monotonic()
+        r = (self.total - self._mark_total) / max(now - self._mark_time, 1e-9)
+        self._mark_total = self.total
+        self._mark_time = now
+        return r
+
+
+class Histogram:
+    # Prometheus-style histogram with one label. Observing is a bisect and
+    # two additions; the text exposition is only built when scraped.
+    def __init__(self, name, description, label=None, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self._label = label
+        self._buckets = buckets
+        self._counts = {}
+        self._sums = {}
+
+    def observe(self, value, key=''):
+        counts = self._counts.get(key)
+        if counts is None:
+            counts = self._counts[key] = [0] * (len(self._buckets) + 1)
+            self._sums[key] = 0.0
+        counts[bisect.bisect_left(self._buckets, value)] += 1
+        self._sums[key] += value
+
+    def exposition(self):
+        lines = ['# HELP %s %s' % (self.name, self.description), '# TYPE %s histogram' % self.name]
+        for key in sorted(self._counts):
+            labels = '%s="%s",' % (self._label, key) if self._label else ''
+            total = 0
+            for le, count in zip(self._buckets + ('+Inf',), self._counts[key]):
+                total += count
+                lines.append('%s_bucket{%sle="%s"} %d' % (self.name, labels, le, total))
+            labels = '{%s}' % labels[:-1] if labels else ''
+            lines.append('%s_sum%s %r' % (self.name, labels, self._sums[key]))
+            lines.append('%s_count%s %d' % (self.name, labels, total))
+        return lines
+
+
+class Metrics:
+    def __init__(self):
+        self.timer_lateness = Histogram(
+                'gfxmpc_timer_lateness_seconds',
+                'How late periodic tasks woke up relative to their deadline.',
+                'task')
+        self.render = Histogram(
+                'gfxmpc_render_seconds',
+                'Time spent drawing widgets into the frame buffer.',
+                'widget')
+        self.flush = Histogram(
+                'gfxmpc_flush_seconds',
+                'Time spent pushing dirty regions to the display.')
+        self.flush_bytes = Histogram(
+                'gfxmpc_flush_bytes',
+                'Bytes sent to the display controller per flush.',
+                buckets=BYTE_BUCKETS)
+        self.lock_wait = Histogram(
+                'gfxmpc_lock_wait_seconds',
+                'Time spent waiting for a lock.',
+                'lock')
+        self.lock_hold = Histogram(
+                'gfxmpc_lock_hold_seconds',
+                'Time a lock was held, excluding idle.',
+                'lock')
+        self.mpd_command = Histogram(
+                'gfxmpc_mpd_command_seconds',
+                'MPD command round-trip time.',
+                'command')
+        self.track_change = Histogram(
+                'gfxmpc_track_change_seconds',
+                'Time from a track change event to its frame being shown.')
+        self.event_round_trips = Histogram(
+                'gfxmpc_event_round_trips',
+                'MPD round trips spent handling one idle event.',
+                buckets=ROUND_TRIP_BUCKETS)
+        self.event_socket = Histogram(
+                'gfxmpc_event_socket_seconds',
+                'Time spent on the MPD socket handling one idle event.')
+        self.touch_command = Histogram(
+                'gfxmpc_touch_command_seconds',
+                'Time from a touch press to MPD acknowledging its command.',
+                'command')
+
+    def exposition(self):
+        lines = []
+        for histogram in vars(self).values():
+            lines.extend(histogram.exposition())
+        return lines
+
+
+metrics = Metrics()
+
+
+class HeadlessDisplay:
+    def __init__(self):
+        self.buf = bytearray(WIDTH * HEIGHT // 8)
+        self.frames = 0
+        self.pushed = RateCounter()
+
+    def show(self, buf, regions):
+        for page, x0, x1 in regions:
+            offset = page * WIDTH
+            self.buf[offset + x0:offset + x1] = buf[offset + x0:offset + x1]
+            self.pushed.add(ST7567_ADDRESS_BYTES + x1 - x0)
+        self.frames += 1
+
+
+class GfxHatDisplay:
+    def __init__(self):
+        self.pushed = RateCounter()
+
+    def show(self, buf, regions):
+        st7567 = lcd.st7567
+        st7567.setup()
+        st7567._command([ST7567_ENTER_RMWMODE])
+        for page, x0, x1 in regions:
+            offset = page * WIDTH
+            st7567._command([ST7567_SETPAGESTART | page, ST7567_SETCOLL | (x0 & 0x0f), ST7567_SETCOLH | (x0 >> 4)])
+            st7567._data(buf[offset + x0:offset + x1])
+            self.pushed.add(ST7567_ADDRESS_BYTES + x1 - x0)
+        st7567._command([ST7567_EXIT_RMWMODE])
+
+
+class SharedMemoryDisplay:
+    # Publishes every frame to a memory-mapped file, POSIX shared memory
+    # under /dev/shm by default, for local mirrors of the panel. Only the
+    # dirty spans are copied in. The sequence counter is odd while a frame
+    # is being written and even once it is complete.
+    #
+    # File layout: header (magic, version, width, height, sequence), then
+    # the frame in the panel's layout: HEIGHT / 8 pages of WIDTH bytes, bit
+    # 0 of each byte being the top row of its page.
+    def __init__(self, path=SHM_PATH):
+        self.path = path
+        self.frames = 0
+        self.pushed = RateCounter()
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, SHM_HEADER.size + WIDTH * HEIGHT // 8)
+            self._map = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+        # Readers left running across a restart never see the counter
+        # go back to a value they have already seen.
+        magic, version, _, _, seq = SHM_HEADER.unpack_from(self._map)
+        self._seq = seq + (seq & 1) if (magic, version) == (SHM_MAGIC, SHM_VERSION) else 0
+        SHM_HEADER.pack_into(self._map, 0, SHM_MAGIC, SHM_VERSION, WIDTH, HEIGHT, self._seq)
+
+    def show(self, buf, regions):
+        view = memoryview(buf)
+        self._seq += 1
+        SHM_SEQUENCE.pack_into(self._map, SHM_HEADER.size - SHM_SEQUENCE.size, self._seq)
+        for page, x0, x1 in regions:
+            offset = page * WIDTH
+            self._map[SHM_HEADER.size + offset + x0:SHM_HEADER.size + offset + x1] = view[offset + x0:offset + x1]
+            self.pushed.add(x1 - x0)
+        self._seq += 1
+        SHM_SEQUENCE.pack_into(self._map, SHM_HEADER.size - SHM_SEQUENCE.size, self._seq)
+        self.frames += 1
+
+    def close(self):
+        self._map.close()
+
+
+class SharedMemoryReader:
+    # The consumer side of SharedMemoryDisplay.
+    def __init__(self, path=SHM_PATH):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.width, self.height, _ = SHM_HEADER.unpack_from(self._map)
+        if magic != SHM_MAGIC or version != SHM_VERSION or len(self._map) != SHM_HEADER.size + self.width * self.height // 8:
+            self._map.close()
+            raise ValueError('%s is not a gfxmpc frame' % path)
+
+    def sequence(self):
+        return SHM_SEQUENCE.unpack_from(self._map, SHM_HEADER.size - SHM_SEQUENCE.size)[0]
+
+    def read(self, seq=None):
+        # Returns the sequence number and a copy of the frame, or None for
+        # the frame if the sequence is still seq. A frame being written
+        # while it was copied is copied again.
+        while True:
+            before = self.sequence()
+            if before == seq:
+                return before, None
+            if before & 1:
+                time.sleep(0)
+                continue
+            frame = self._map[SHM_HEADER.size:]
+            if self.sequence() == before:
+                return before, frame
+
+    def close(self):
+        self._map.close()
+
+
+class MultiDisplay:
+    # Sends every frame to several displays. The first one is the panel,
+    # whose byte count is reported.
+    def __init__(self, *displays):
+        self.displays = displays
+        self.pushed = displays[0].pushed
+
+    def show(self, buf, regions):
+        for display in self.displays:
+            display.show(buf, regions)
+
+
+class FrameBuffer:
+    def __init__(self, display):
+        self._display = display
+        self.buf = bytearray(WIDTH * HEIGHT // 8)
+        self.on_dirty = None
+        self.invalidate()
+
+    def _mark(self, page, x0, x1):
+        if self.on_dirty is not None:
+            self.on_dirty()
+        # Spans closer than the cost of re-addressing the panel are merged.
+        spans = self._dirty[page]
+        for span in spans:
+            if x0 <= span[1] + ST7567_ADDRESS_BYTES and span[0] <= x1 + ST7567_ADDRESS_BYTES:
+                spans.remove(span)
+                self._mark(page, min(x0, span[0]), max(x1, span[1]))
+                return
+        spans.append((x0, x1))
+
+    def _merge(self, page, x, bits, mask):
+        if page >= HEIGHT // 8 or mask == 0:
+            return
+        n = len(bits)
+        offset = page * WIDTH + x
+        old = self.buf[offset:offset + n]
+        if mask == 0xff:
+            new = bits
+        else:
+            m = int.from_bytes(bytes((mask,)) * n, 'little')
+            dst = int.from_bytes(old, 'little')
+            src = int.from_bytes(bits, 'little')
+            new = ((dst & ~m) | (src & m)).to_bytes(n, 'little')
+        if old == new:
+            return
+        self.buf[offset:offset + n] = new
+        diff = int.from_bytes(old, 'little') ^ int.from_bytes(new, 'little')
+        lo = ((diff & -diff).bit_length() - 1) // 8
+        hi = (diff.bit_length() - 1) // 8 + 1
+        self._mark(page, x + lo, x + hi)
+
+    def _write(self, x, y, height, pages):
+        page, shift = divmod(y, 8)
+        for k, bits in enumerate(pages):
+            mask = (1 << min(8, height - 8 * k)) - 1
+            self._merge(page + k, x, bits.translate(_SHIFT_UP[shift]), (mask << shift) & 0xff)
+            if shift:
+                self._merge(page + k + 1, x, bits.translate(_SHIFT_DOWN[shift]), mask >> (8 - shift))
+
+    def blit(self, x, y, bitmap, sx=0, w=None):
+        if w is None:
+            w = bitmap.width - sx
+        w = min(w, WIDTH - x)
+        if w <= 0:
+            return
+        self._write(x, y, bitmap.height, [p[sx:sx + w] for p in bitmap.pages])
+
+    def fill(self, x, y, w, h, value):
+        w = min(w, WIDTH - x)
+        if w <= 0 or h <= 0:
+            return
+        bits = bytes((0xff if value else 0,)) * w
+        self._write(x, y, h, [bits] * ((h + 7) // 8))
+
+    def load(self, buf, regions=None):
+        if regions is None:
+            regions = [(page, 0, WIDTH) for page in range(HEIGHT // 8)]
+        for page, x0, x1 in regions:
+            offset = page * WIDTH
+            self._merge(page, x0, buf[offset + x0:offset + x1], 0xff)
+
+    def clear(self):
+        self.fill(0, 0, WIDTH, HEIGHT, 0)
+
+    def invalidate(self):
+        self._dirty = [[(0, WIDTH)] for _ in range(HEIGHT // 8)]
+
+    def take(self):
+        regions = [(page, x0, x1) for page, spans in enumerate(self._dirty) for x0, x1 in spans]
+        self._dirty = [[] for _ in range(HEIGHT // 8)]
+        return regions
+
+    def show(self):
+        regions = self.take()
+        if not regions:
+            return 0
+        self._display.show(self.buf, regions)
+        return sum(x1 - x0 + ST7567_ADDRESS_BYTES for _, x0, x1 in regions)
+
+
+class BitmapCache:
+    def __init__(self, capacity):
+        self._capacity = capacity
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        try:
+            bitmap = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return bitmap
+
+    def put(self, key, bitmap):
+        size = bitmap.width * len(bitmap.pages)
+        if size > self._capacity:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._size -= old.width * len(old.pages)
+        self._entries[key] = bitmap
+        self._size += size
+        while self._size > self._capacity:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= evicted.width * len(evicted.pages)
+            self.evictions += 1
+
+    def stats(self):
+        return {
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'capacity': self._capacity,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+        }
+
+
+text_cache = BitmapCache(TEXT_CACHE_SIZE)
+
+
+class GlyphAtlas:
+    # Unifont glyphs for the Basic Multilingual Plane, rasterised once from
+    # the PCF into page-packed cells and memory-mapped on later starts, so
+    # text is drawn by copying glyph columns without PIL or the font loaded.
+    # Halfwidth glyphs use the first 8 columns of their cell, fullwidth
+    # glyphs all 16.
+    #
+    # File layout: header, one advance width byte per code point (0 for
+    # surrogates and zero-width glyphs), then one cell per code point
+    # holding the top page followed by the bottom page.
+    def __init__(self, path, data):
+        self.path = path
+        self.size = FONT_SIZE
+        self._data = data
+        self._widths = data[ATLAS_HEADER.size:ATLAS_HEADER.size + ATLAS_SIZE]
+        self._cells = ATLAS_HEADER.size + ATLAS_SIZE
+
+    @staticmethod
+    def _header(font_path):
+        st = os.stat(font_path)
+        return ATLAS_HEADER.pack(ATLAS_MAGIC, ATLAS_VERSION, FONT_SIZE, st.st_size, st.st_mtime_ns)
+
+    @classmethod
+    def load(cls, font_path, atlas_path):
+        header = cls._header(font_path)
+        try:
+            with open(atlas_path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        if data[:ATLAS_HEADER.size] != header or len(data) != ATLAS_HEADER.size + ATLAS_SIZE * (1 + 2 * GLYPH_WIDTH):
+            data.close()
+            return None
+        return cls(font_path, data)
+
+    @classmethod
+    def build(cls, font_path, atlas_path):
+        from PIL import Image, ImageDraw, ImageFont
+        font = ImageFont.truetype(font_path, FONT_SIZE)
+        widths = bytearray(ATLAS_SIZE)
+        cells = bytearray(ATLAS_SIZE * 2 * GLYPH_WIDTH)
+        image = Image.new('1', (GLYPH_WIDTH, FONT_SIZE))
+        draw = ImageDraw.Draw(image)
+        for cp in range(ATLAS_SIZE):
+            if 0xd800 <= cp < 0xe000:
+                continue
+            w = min(int(font.getlength(chr(cp))), GLYPH_WIDTH)
+            if w <= 0:
+                continue
+            draw.rectangle((0, 0, GLYPH_WIDTH, FONT_SIZE), 0)
+            draw.text((0, 0), chr(cp), 1, font)
+            top, bottom = Bitmap.from_image(image).pages
+            widths[cp] = w
+            cells[cp * 2 * GLYPH_WIDTH:(cp + 1) * 2 * GLYPH_WIDTH] = top + bottom
+        with open(atlas_path + '.tmp', 'wb') as f:
+            f.write(cls._header(font_path))
+            f.write(widths)
+            f.write(cells)
+        os.replace(atlas_path + '.tmp', atlas_path)
+
+    @classmethod
+    def open(cls, font_path, atlas_path):
+        atlas = cls.load(font_path, atlas_path)
+        if atlas is None:
+            cls.build(font_path, atlas_path)
+            atlas = cls.load(font_path, atlas_path)
+        return atlas
+
+    def render(self, text):
+        # Long strings are clipped to TEXT_STRIP_LIMIT, short ones centred.
+        data = self._data
+        widths = self._widths
+        top = []
+        bottom = []
+        w = 0
+        for cp in map(ord, text):
+            if cp >= ATLAS_SIZE:
+                cp = REPLACEMENT_CHAR
+            n = widths[cp]
+            if not n:
+                continue
+            o = self._cells + cp * 2 * GLYPH_WIDTH
+            top.append(data[o:o + n])
+            bottom.append(data[o + GLYPH_WIDTH:o + GLYPH_WIDTH + n])
+            w += n
+            if w >= TEXT_STRIP_LIMIT:
+                break
+        top = b''.join(top)
+        bottom = b''.join(bottom)
+        if w > TEXT_STRIP_LIMIT:
+            w = TEXT_STRIP_LIMIT
+            top = top[:w]
+            bottom = bottom[:w]
+        elif w < WIDTH:
+            indent = bytes((WIDTH - w) // 2)
+            tail = bytes(WIDTH - w - len(indent))
+            top = indent + top + tail
+            bottom = indent + bottom + tail
+            w = WIDTH
+        return Bitmap(w, FONT_SIZE, [top, bottom])
+
+
+def render_text(font, text):
+    key = (text, font.path, font.size)
+    bitmap = text_cache.get(key)
+    if bitmap is not None:
+        return bitmap
+    bitmap = font.render(text)
+    text_cache.put(key, bitmap)
+    return bitmap
+
+
+def song_texts(song):
+    return [song.get('title', '-'), song.get('artist', '-'), song.get('album', '-')]
+
+
+class Compositor:
+    # Widgets only write into their pages; every change to the page on
+    # screen schedules a flush, and flushes are spaced at least one frame
+    # interval apart.
+    def __init__(self, fb, fps):
+        self._fb = fb
+        self._interval = 1 / fps
+        self._pending = None
+        self._waiters = []
+        self._last_flush = 0
+        self.flushes = RateCounter()
+        self.frame_times = collections.deque(maxlen=LATENCY_SAMPLES)
+        fb.on_dirty = self.invalidate
+
+    def invalidate(self):
+        if self._pending is not None:
+            return
+        loop = asyncio.get_running_loop()
+        delay = self._last_flush + self._interval - loop.time()
+        if delay > 0:
+            self._pending = loop.call_later(delay, self.flush)
+        else:
+            self._pending = loop.call_soon(self.flush)
+
+    def flush(self):
+        if self._pending is not None:
+            self._pending.cancel()
+            self._pending = None
+        t = time.perf_counter()
+        size = self._fb.show()
+        t = time.perf_counter() - t
+        self.frame_times.append(t)
+        if size:
+            metrics.flush.observe(t)
+            metrics.flush_bytes.observe(size)
+        self._last_flush = asyncio.get_running_loop().time()
+        self.flushes.add(1)
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._waiters.clear()
+
+    async def frame(self):
+        if self._pending is None:
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        await waiter
+
+    def stats(self):
+        frame_times = self.frame_times or (0,)
+        return {
+                'flushes': self.flushes.total,
+                'flushes_per_second': self.flushes.rate(),
+                'frame_time_avg': sum(frame_times) / len(frame_times),
+                'frame_time_max': max(frame_times)
+        }
+
+
+class PageView:
+    # Draws into several pages at once, for widgets they have in common.
+    def __init__(self, pages):
+        self._pages = pages
+
+    def blit(self, x, y, bitmap, sx=0, w=None):
+        for page in self._pages:
+            page.blit(x, y, bitmap, sx, w)
+
+    def fill(self, x, y, w, h, value):
+        for page in self._pages:
+            page.fill(x, y, w, h, value)
+
+
+class Pages:
+    # Every screen has an off-screen buffer of its own that its widgets keep
+    # up to date while it is hidden, so switching screens is loading that
+    # buffer into the panel's, which marks only the bytes that differ.
+    # Overlays are pages shown over the current one, for a while or until
+    # hidden, after which it comes back as it was left.
+    def __init__(self, fb):
+        self._fb = fb
+        self._pages = {}
+        self._overlays = []
+        self._timers = {}
+        self.current = None
+        self.on_dirty = None
+
+    def add(self, name):
+        page = FrameBuffer(None)
+        page.on_dirty = lambda: self._changed(name)
+        self._pages[name] = page
+        if self.current is None:
+            self.current = name
+        return page
+
+    def page(self, name):
+        return self._pages[name]
+
+    def view(self, *names):
+        # Pages never added, such as screens that are unavailable, are
+        # left out.
+        return PageView([self._pages[name] for name in names if name in self._pages])
+
+    def visible(self):
+        return self._overlays[-1] if self._overlays else self.current
+
+    def _changed(self, name):
+        if name == self.visible() and self.on_dirty is not None:
+            self.on_dirty()
+
+    def _load(self):
+        page = self._pages[self.visible()]
+        page.take()
+        self._fb.load(page.buf)
+        if self.on_dirty is not None:
+            self.on_dirty()
+
+    def switch(self, name):
+        self.current = name
+        if not self._overlays:
+            self._load()
+
+    def show_overlay(self, name, timeout=None):
+        timer = self._timers.pop(name, None)
+        if timer is not None:
+            timer.cancel()
+        if name in self._overlays:
+            self._overlays.remove(name)
+        self._overlays.append(name)
+        if timeout is not None:
+            self._timers[name] = asyncio.get_running_loop().call_later(timeout, self.hide_overlay, name)
+        self._load()
+
+    def hide_overlay(self, name):
+        timer = self._timers.pop(name, None)
+        if timer is not None:
+            timer.cancel()
+        if name in self._overlays:
+            self._overlays.remove(name)
+            self._load()
+
+    def show(self):
+        # Only what changed on the visible page since the last frame is
+        # copied into the panel's buffer.
+        page = self._pages[self.visible()]
+        regions = page.take()
+        if regions:
+            self._fb.load(page.buf, regions)
+        return self._fb.show()
+
+    def close(self):
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+
+
+class Scheduler:
+    # One timer heap for every periodic display job. A wakeup runs all jobs
+    # due within the slack window, so their draws share one frame instead
+    # of waking the loop a few milliseconds apart.
+    #
+    # A job is called with its deadline and returns the next one, or None
+    # when it is done. Cancelled entries are only marked; they are dropped
+    # when they reach the top of the heap. Deadlines are in the time of
+    # clock, which must be monotonic like the loop's own clock: a wall clock
+    # stepped by NTP would fire a burst of catch-up runs or stall every job.
+    def __init__(self, slack=TIMER_SLACK, clock=time.monotonic):
+        self._slack = slack
+        self._clock = clock
+        self._heap = []
+        self._seq = 0
+        self._handle = None
+        self._armed = None
+        self.wakeups = RateCounter()
+
+    def schedule(self, deadline, job, name):
+        self._seq += 1
+        entry = [deadline, self._seq, job, name]
+        heapq.heappush(self._heap, entry)
+        self._rearm()
+        return entry
+
+    def cancel(self, entry):
+        entry[2] = None
+        if self._heap and self._heap[0] is entry:
+            self._rearm()
+
+    def close(self):
+        self._heap.clear()
+        self._rearm()
+
+    def _rearm(self):
+        heap = self._heap
+        while heap and heap[0][2] is None:
+            heapq.heappop(heap)
+        deadline = heap[0][0] if heap else None
+        if deadline == self._armed:
+            return
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self._armed = deadline
+        if deadline is not None:
+            self._handle = asyncio.get_running_loop().call_later(max(deadline - self._clock(), 0), self._run)
+
+    def _run(self):
+        self._handle = None
+        self._armed = None
+        self.wakeups.add(1)
+        heap = self._heap
+        now = self._clock()
+        while heap and heap[0][0] <= now + self._slack:
+            entry = heapq.heappop(heap)
+            deadline, _, job, name = entry
+            if job is None:
+                continue
+            metrics.timer_lateness.observe(max(now - deadline, 0), name)
+            deadline = job(deadline)
+            if deadline is None or entry[2] is None:
+                entry[2] = None
+            else:
+                self._seq += 1
+                entry[0] = deadline
+                entry[1] = self._seq
+                heapq.heappush(heap, entry)
+        self._rearm()
 
 
 class Text:
-    def __init__(self, y, font, text):
+    def __init__(self, fb, y, font, text):
+        self._fb = fb
         self._pos_y = y
         self._font = font
         self._text = text
         self._scrollable = 0
         self._scrolled = 0
+        self.hidden = False
            
-    def draw(self):
+    def render(self):
         self._scrolled = 0
-        w, h = self._font.getsize(self._text)
-        indent = 0
-        if w > WIDTH:
-            self._scrollable = w
-            w += WIDTH
-        elif w < WIDTH:
-            self._scrollable = 0
-            indent = (WIDTH - w) / 2
-            w = WIDTH
+        self._bitmap = render_text(self._font, self._text)
+        if self._bitmap.width > WIDTH:
+            self._scrollable = self._bitmap.width
         else:
             self._scrollable = 0
-        self._image = Image.new('1', (w, h))
-        draw = ImageDraw.Draw(self._image)
-        draw.text((indent, 0), self._text, 1, self._font)
-        for y in range(FONT_SIZE):
-            for x in range(WIDTH):
-                pixel = self._image.getpixel((x, y))
-                lcd.set_pixel(x, self._pos_y + y, pixel)
+
+    def draw(self):
+        self.render()
+        self._blit()
+
+    def _blit(self):
+        # The strip holds only the text itself; the blank tail that scrolls
+        # in after it is filled here instead of being stored.
+        visible = max(self._bitmap.width - self._scrolled, 0)
+        self._fb.blit(0, self._pos_y, self._bitmap, self._scrolled, WIDTH)
+        self._fb.fill(visible, self._pos_y, WIDTH - visible, self._bitmap.height, 0)
 
     def is_scrollable(self):
-        if self._scrollable == 0:
+        if self._scrollable == 0 or self.hidden:
             return False
         else:
             return True
@@ -174,47 +1041,46 @@ class Text:
 
     def scroll(self):
         self._scrolled = (self._scrolled + 1) % (self._scrollable + 1)
-        for y in range(FONT_SIZE):
-            for x in range(WIDTH):
-                pixel = self._image.getpixel((x + self._scrolled, y))
-                lcd.set_pixel(x, self._pos_y + y, pixel)
-        lcd.show()
+        self._blit()
+
+    def reset(self):
+        if self._scrolled:
+            self._scrolled = 0
+            self._blit()
 
     def set_text(self, t):
         self._text = t
 
 
 class ProgressBar:
-    def __init__(self, y):
+    def __init__(self, fb, y):
+        self._fb = fb
         self._pos_y = y
         self._progress = 0
-        for x in range(WIDTH):
-            lcd.set_pixel(x, self._pos_y, 1)
-            lcd.set_pixel(x, self._pos_y + BAR_SIZE + 1, 1)
-        for y in range(BAR_SIZE):
-            lcd.set_pixel(0, self._pos_y + y + 1, 1)
-            lcd.set_pixel(WIDTH - 1, self._pos_y + y + 1, 1)
+        self._draw_border()
+
+    def _draw_border(self):
+        self._fb.fill(0, self._pos_y, WIDTH, 1, 1)
+        self._fb.fill(0, self._pos_y + BAR_SIZE + 1, WIDTH, 1, 1)
+        self._fb.fill(0, self._pos_y + 1, 1, BAR_SIZE, 1)
+        self._fb.fill(WIDTH - 1, self._pos_y + 1, 1, BAR_SIZE, 1)
 
     def draw(self):
-        for y in range(BAR_SIZE):
-            for x in range(self._progress):
-                lcd.set_pixel(x + 1, self._pos_y + y + 1, 1)
-        for y in range(BAR_SIZE):
-            for x in range(self._progress, WIDTH - 2):
-                lcd.set_pixel(x + 1, self._pos_y + y + 1, 0)
+        self._draw_border()
+        self._fb.fill(1, self._pos_y + 1, self._progress, BAR_SIZE, 1)
+        self._fb.fill(self._progress + 1, self._pos_y + 1, WIDTH - 2 - self._progress, BAR_SIZE, 0)
 
     def set_progress(self, p):
         self._progress = p
 
     def update(self):
         self._progress += 1
-        for y in range(BAR_SIZE):
-            lcd.set_pixel(self._progress, self._pos_y + y + 1, 1)
-        lcd.show()
+        self._fb.fill(self._progress, self._pos_y + 1, 1, BAR_SIZE, 1)
 
 
 class Time:
-    def __init__(self, x, y):
+    def __init__(self, fb, x, y):
+        self._fb = fb
         self._pos_x = x
         self._pos_y = y
         self._min_10 = 0
@@ -223,13 +1089,10 @@ class Time:
         self._sec_1 = 0
 
     def _write_number(self, col, n):
-        for dy in range(NUM_CHAR_HEIGHT):
-            for dx in range(NUM_CHAR_WIDTH - 1):
-                lcd.set_pixel(self._pos_x + NUM_CHAR_WIDTH * col + dx, self._pos_y + dy, NUM_CHAR[n][dy][dx])
+        self._fb.blit(self._pos_x + NUM_CHAR_WIDTH * col, self._pos_y, NUM_BITMAP[n])
 
     def _write_colon(self, col):
-        lcd.set_pixel(self._pos_x + NUM_CHAR_WIDTH * col + 2, self._pos_y + 1, 1)
-        lcd.set_pixel(self._pos_x + NUM_CHAR_WIDTH * col + 2, self._pos_y + 5, 1)
+        self._fb.blit(self._pos_x + NUM_CHAR_WIDTH * col + 2, self._pos_y, COLON_BITMAP)
 
     def draw(self):
         self._write_number(0, self._min_10)
@@ -265,384 +1128,1947 @@ class Time:
                 self._write_number(3, self._sec_10)
         else:
             self._write_number(4, self._sec_1)
-        lcd.show()
-
-
-class MPC:
-    def __init__(self):
-        self._mpd_monitor= MPDClient()
-        self._mpd_controller = MPDClient()
 
-        self._current_songid = -1
-
-        self._event_term = threading.Event()
-        self._event_cancel = threading.Event()
-        self._event_scroll = threading.Event()
-        self._event_update = threading.Event()
 
-        self._scheduler_keepalive = sched.scheduler(time.time, self._event_term.wait)
-        self._scheduler_text = sched.scheduler(time.time, self._event_cancel.wait)
-        self._scheduler_progress = sched.scheduler(time.time, self._event_cancel.wait)
-        self._scheduler_elapsed = sched.scheduler(time.time, self._event_cancel.wait)
+class Indicators:
+    # Repeat/random/single/consume flags between the two Time widgets.
+    def __init__(self, fb, x, y):
+        self._fb = fb
+        self._pos_x = x
+        self._pos_y = y
+        self._flags = ''
 
-        self._waiting_keepalive = None
-        self._waiting_text = None
-        self._waiting_progress = None
-        self._waiting_elapsed = None
+    def set_options(self, status):
+        self._flags = ''.join(c if status.get(key, '0') != '0' else ' ' for c, key in (('R', 'repeat'), ('Z', 'random'), ('S', 'single'), ('C', 'consume')))
 
-        self._thread_keepalive = threading.Thread(target=self._keepalive_handler)
-        self._thread_text = threading.Thread(target=self._text_scroll_handler)
-        self._thread_progress = threading.Thread(target=self._progress_update_handler)
-        self._thread_elapsed = threading.Thread(target=self._elapsed_update_handler)
+    def draw(self):
+        for col, c in enumerate(self._flags.ljust(4)):
+            if c.isdigit():
+                bitmap = NUM_BITMAP[int(c)]
+            else:
+                bitmap = LETTER_BITMAP.get(c, BLANK_BITMAP)
+            self._fb.blit(self._pos_x + NUM_CHAR_WIDTH * col, self._pos_y, bitmap)
 
-        self._lock = threading.Lock()
 
+# numpy takes seconds to import on a Pi Zero, so it is only loaded once
+# the spectrum or the art renderer needs it.
+numpy = None
 
-    def _keepalive_handler(self):
-        while not self._event_term.is_set():
-            self._waiting_keepalive = self._scheduler_keepalive.enter(59, 1, self._keepalive)
-            self._scheduler_keepalive.run()
 
+def import_numpy():
+    # Imports numpy into the module namespace; returns False if it is not
+    # installed.
+    global numpy
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            return False
+    return True
 
-    def _text_scroll_handler(self):
-        while not self._event_term.is_set():
-            self._event_scroll.wait()
-            idx = 0
-            while not self._event_term.is_set() and self._event_scroll.is_set():
-                if self._text_info[idx].is_scrollable():
-                    self._waiting_text = self._scheduler_text.enter(1.5, 1, self._scroll_text, argument=(self._text_info[idx],))
-                    self._scheduler_text.run()
-                    while not self._event_term.is_set() and self._text_info[idx].is_scrolled() and self._event_scroll.is_set():
-                        self._waiting_text = self._scheduler_text.enter(0.1, 1, self._scroll_text, argument=(self._text_info[idx],))
-                        self._scheduler_text.run()
-                idx = (idx + 1) % 3
 
+class Spectrum:
+    # Bar graph of the audio MPD writes to a fifo output (s16le stereo at
+    # SPECTRUM_RATE). Each frame drains whatever the pipe holds into a ring
+    # buffer without blocking, runs a batch of overlapping Hann-windowed
+    # FFTs over the newest samples and max-pools them into one log-spaced
+    # band per column.
+    def __init__(self, fb, y, path):
+        self._fb = fb
+        self._pos_y = y
+        self._path = path
+        self._fd = None
+        self._partial = b''
+        self._ring = numpy.zeros(SPECTRUM_RING, numpy.float32)
+        self._written = 0
+        self._span = numpy.arange(SPECTRUM_FFT_SIZE * (SPECTRUM_WINDOWS + 1) // 2)
+        self._window = numpy.hanning(SPECTRUM_FFT_SIZE).astype(numpy.float32)
+        self._scale = 2 / (self._window.sum() * 32768)
+        freqs = numpy.fft.rfftfreq(SPECTRUM_FFT_SIZE, 1 / SPECTRUM_RATE)
+        edges = numpy.geomspace(SPECTRUM_MIN_FREQ, SPECTRUM_RATE / 2, WIDTH + 1)[:-1]
+        self._bins = numpy.clip(numpy.searchsorted(freqs, edges), 1, len(freqs) - 1)
+        self._rows = numpy.arange(SPECTRUM_HEIGHT)
+        self._heights = numpy.zeros(WIDTH, numpy.int16)
+        self._bitmap = Bitmap(WIDTH, SPECTRUM_HEIGHT)
+        self._cost = 0.0
+        self.dropped = 0
+
+    def open(self):
+        if self._fd is None:
+            try:
+                self._fd = os.open(self._path, os.O_RDONLY | os.O_NONBLOCK)
+            except OSError:
+                pass
 
-    def _progress_update_handler(self):
-        while not self._event_term.is_set():
-            self._event_update.wait()
-            while not self._event_term.is_set() and self._event_update.is_set():
-                self._t_progressed += self._progress_update_interval
-                if self._t_progressed <= self._t_duration:
-                    self._waiting_progress = self._scheduler_progress.enterabs(self._t_origin + self._t_progressed, 1, self._update_progress)
-                    self._scheduler_progress.run()
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self._partial = b''
+        self._heights[:] = 0
+        self._bitmap = Bitmap(WIDTH, SPECTRUM_HEIGHT)
+
+    def _read(self):
+        self.open()
+        if self._fd is None:
+            return 0
+        chunks = [self._partial]
+        while True:
+            try:
+                data = os.read(self._fd, SPECTRUM_READ_SIZE)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            chunks.append(data)
+        data = b''.join(chunks)
+        n = len(data) // 4
+        self._partial = data[n * 4:]
+        if not n:
+            return 0
+        samples = numpy.frombuffer(data, '<i2', n * 2).reshape(n, 2).mean(axis=1, dtype=numpy.float32)[-SPECTRUM_RING:]
+        self._ring[(self._written + numpy.arange(len(samples))) & (SPECTRUM_RING - 1)] = samples
+        self._written += len(samples)
+        return n
+
+    def _levels(self):
+        tail = self._ring[(self._written - len(self._span) + self._span) & (SPECTRUM_RING - 1)]
+        hop = SPECTRUM_FFT_SIZE // 2
+        frames = numpy.stack([tail[k * hop:k * hop + SPECTRUM_FFT_SIZE] for k in range(SPECTRUM_WINDOWS)])
+        magnitude = numpy.abs(numpy.fft.rfft(frames * self._window, axis=1)).mean(axis=0)
+        db = 20 * numpy.log10(numpy.maximum.reduceat(magnitude, self._bins) * self._scale + 1e-9)
+        return numpy.clip((db - SPECTRUM_FLOOR_DB) * (SPECTRUM_HEIGHT / -SPECTRUM_FLOOR_DB), 0, SPECTRUM_HEIGHT).astype(numpy.int16)
+
+    def _render(self):
+        lit = self._rows >= (SPECTRUM_HEIGHT - self._heights)[:, None]
+        packed = numpy.packbits(lit.reshape(WIDTH, SPECTRUM_HEIGHT // 8, 8), axis=2, bitorder='little')
+        return Bitmap(WIDTH, SPECTRUM_HEIGHT, [packed[:, k, 0].tobytes() for k in range(SPECTRUM_HEIGHT // 8)])
 
+    def draw(self):
+        self._fb.blit(0, self._pos_y, self._bitmap)
 
-    def _elapsed_update_handler(self):
-        while not self._event_term.is_set():
-            self._event_update.wait()
-            while not self._event_term.is_set() and self._event_update.is_set():
-                self._t_elapsed += 1
-                if self._t_elapsed <= self._t_duration:
-                    self._waiting_elapsed = self._scheduler_elapsed.enterabs(self._t_origin + self._t_elapsed, 1, self._update_elapsed)
-                    self._scheduler_elapsed.run()
+    def update(self):
+        t = time.perf_counter()
+        falling = self._heights - SPECTRUM_FALL
+        if self._read():
+            self._heights = numpy.maximum(self._levels(), falling)
+        else:
+            self._heights = numpy.maximum(falling, 0)
+        self._bitmap = self._render()
+        self.draw()
+        self._cost += (time.perf_counter() - t - self._cost) * 0.1
+
+    def interval(self):
+        # Frames are spaced so that drawing them stays within the budget.
+        return max(1 / SPECTRUM_FPS, self._cost / SPECTRUM_CPU_BUDGET)
+
+
+def dither(gray):
+    # Floyd-Steinberg, vectorised along wavefronts x + 2y = k: a pixel only
+    # takes error from (x - 1, y), (x - 1, y - 1), (x, y - 1) and
+    # (x + 1, y - 1), all on earlier wavefronts, so each wavefront is
+    # quantised in one step. The padding absorbs error pushed off the edges.
+    h, w = gray.shape
+    img = numpy.zeros((h + 1, w + 2), numpy.float32)
+    img[:h, 1:w + 1] = gray
+    out = numpy.zeros((h, w), bool)
+    rows = numpy.arange(h)
+    for k in range(w + 2 * (h - 1)):
+        y = rows[(k - 2 * rows >= 0) & (k - 2 * rows < w)]
+        x = k - 2 * y
+        value = img[y, x + 1]
+        on = value >= 128
+        out[y, x] = on
+        error = value - on * 255
+        img[y, x + 2] += error * (7 / 16)
+        img[y + 1, x] += error * (3 / 16)
+        img[y + 1, x + 1] += error * (5 / 16)
+        img[y + 1, x + 2] += error * (1 / 16)
+    return out
+
+
+def render_art(data):
+    # Decodes a cover image and returns the page-packed 1-bit bitmap of the
+    # art area, or b'' if it cannot be decoded.
+    from PIL import Image
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.draft('L', (ART_HEIGHT, ART_HEIGHT))
+        image = image.convert('L')
+        image.thumbnail((WIDTH, ART_HEIGHT))
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return b''
+    canvas = Image.new('L', (WIDTH, ART_HEIGHT))
+    canvas.paste(image, ((WIDTH - image.width) // 2, (ART_HEIGHT - image.height) // 2))
+    if not import_numpy():
+        return b''.join(Bitmap.from_image(canvas.convert('1')).pages)
+    out = dither(numpy.asarray(canvas, numpy.float32))
+    return numpy.packbits(out.reshape(ART_HEIGHT // 8, 8, WIDTH), axis=1, bitorder='little').tobytes()
+
+
+def art_key(song):
+    parts = (song.get('albumartist') or song.get('artist', ''), song.get('album') or os.path.dirname(song.get('file', '')))
+    return hashlib.sha1('\0'.join(parts).encode('utf-8')).hexdigest()
+
+
+class ArtCache:
+    # Dithered cover art on disk, one file per album, least recently used
+    # first out once the directory grows past its capacity. An empty file
+    # records an album without art. Used from executor threads, so puts
+    # and their eviction pass are serialised.
+    def __init__(self, path, capacity):
+        self._path = path
+        self._capacity = capacity
+        self._lock = threading.Lock()
+        self._size = 0
+        try:
+            with os.scandir(path) as entries:
+                self._size = sum(e.stat().st_size for e in entries if e.is_file())
+        except FileNotFoundError:
+            pass
 
+    def get(self, key):
+        path = os.path.join(self._path, key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, key, data):
+        os.makedirs(self._path, exist_ok=True)
+        path = os.path.join(self._path, key)
+        with self._lock:
+            with open(path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(path + '.tmp', path)
+            self._size += len(data)
+            if self._size > self._capacity:
+                with os.scandir(self._path) as entries:
+                    files = sorted((e.stat().st_mtime, e.stat().st_size, e.path) for e in entries if e.is_file())
+                self._size = sum(size for _, size, _ in files)
+                for _, size, old in files:
+                    if self._size <= self._capacity:
+                        break
+                    os.unlink(old)
+                    self._size -= size
+
+
+_LRC_TIME = re.compile(r'\[(\d+):(\d+(?:[.:]\d+)?)\]')
+_LRC_OFFSET = re.compile(r'\[offset:\s*([+-]?\d+)\]', re.IGNORECASE)
+_LRC_WORD = re.compile(r'<\d+:\d+(?:[.:]\d+)?>')
+
+
+def parse_lrc(text):
+    # Returns the sorted timestamps and the line shown from each. A line
+    # may carry several timestamps, and lines sharing one are joined;
+    # [offset:ms] moves every line earlier, word timings are dropped.
+    offset = 0
+    entries = {}
+    for line in text.splitlines():
+        line = line.strip()
+        m = _LRC_OFFSET.match(line)
+        if m is not None:
+            offset = int(m.group(1)) / 1000
+            continue
+        stamps = []
+        pos = 0
+        while True:
+            m = _LRC_TIME.match(line, pos)
+            if m is None:
+                break
+            stamps.append(int(m.group(1)) * 60 + float(m.group(2).replace(':', '.')))
+            pos = m.end()
+        lyric = _LRC_WORD.sub('', line[pos:]).strip()
+        for t in stamps:
+            entries.setdefault(t, []).append(lyric)
+    times = sorted(entries)
+    return [t - offset for t in times], [' / '.join(filter(None, entries[t])) for t in times]
+
+
+def read_lrc(path):
+    try:
+        with open(path, encoding='utf-8-sig', errors='replace') as f:
+            return parse_lrc(f.read())
+    except OSError:
+        return [], []
+
+
+class LyricsCache:
+    # Parsed LRC files by path, least recently used evicted first. Songs
+    # without a file are kept too, as empty lyrics.
+    def __init__(self, capacity):
+        self._capacity = capacity
+        self._entries = collections.OrderedDict()
+
+    def get(self, path):
+        lyrics = self._entries.get(path)
+        if lyrics is not None:
+            self._entries.move_to_end(path)
+        return lyrics
+
+    def put(self, path, lyrics):
+        self._entries[path] = lyrics
+        self._entries.move_to_end(path)
+        while len(self._entries) > self._capacity:
+            self._entries.popitem(last=False)
+
+
+def _number(value):
+    # Track and disc tags look like '3' or '3/12'.
+    digits = (value or '').partition('/')[0].strip()
+    return int(digits) if digits.isdigit() else 0
+
+
+def _sorted_names(names):
+    names = sorted(names, key=str.casefold)
+    return names, [name.casefold() for name in names]
+
+
+def song_record(song):
+    return (
+            song.get('albumartist') or song.get('artist') or '[Unknown]',
+            song.get('album') or '[Unknown]',
+            _number(song.get('disc')),
+            _number(song.get('track')),
+            song.get('title') or os.path.basename(song['file'])
+    )
+
+
+def prefix_jump(keys, i, direction):
+    # Moves to the first entry of the next initial, or back to the start
+    # of the current one and then the previous one.
+    if direction > 0:
+        return min(bisect.bisect_left(keys, chr(ord(keys[i][:1] or '\0') + 1)), len(keys) - 1)
+    start = bisect.bisect_left(keys, keys[i][:1])
+    if start == i and i > 0:
+        start = bisect.bisect_left(keys, keys[i - 1][:1])
+    return start
+
+
+class Library:
+    # Every song of the MPD database, kept on disk between runs and brought
+    # up to date from database idle events, so browsing never waits on MPD.
+    # The sorted lists are rebuilt off the loop after each sync and swapped
+    # in as a whole; keys hold the casefolded names for prefix lookups.
+    #
+    # File layout: header, then the zlib-compressed songs, one line each
+    # with NUL-separated fields.
+    def __init__(self, path):
+        self._path = path
+        self._songs = {}
+        self._index = (([], []), {}, {})
+        self.db_update = 0
+
+    def __len__(self):
+        return len(self._songs)
+
+    def files(self):
+        return self._songs.keys()
+
+    def load(self):
+        try:
+            with open(self._path, 'rb') as f:
+                header = f.read(LIBRARY_HEADER.size)
+                body = f.read()
+        except OSError:
+            return
+        if len(header) != LIBRARY_HEADER.size:
+            return
+        magic, version, db_update = LIBRARY_HEADER.unpack(header)
+        if magic != LIBRARY_MAGIC or version != LIBRARY_VERSION:
+            return
+        try:
+            body = zlib.decompress(body).decode('utf-8')
+        except (zlib.error, UnicodeDecodeError):
+            return
+        # Artist and album names are shared between their songs.
+        songs = {}
+        names = {}
+        for line in body.split('\n') if body else ():
+            uri, artist, album, disc, track, title = line.split('\0')
+            songs[uri] = (names.setdefault(artist, artist), names.setdefault(album, album), int(disc), int(track), title)
+        self._songs = songs
+        self.db_update = db_update
+        self._reindex()
+
+    def save(self):
+        body = '\n'.join('\0'.join((uri, artist, album, str(disc), str(track), title))
+                for uri, (artist, album, disc, track, title) in self._songs.items())
+        with open(self._path + '.tmp', 'wb') as f:
+            f.write(LIBRARY_HEADER.pack(LIBRARY_MAGIC, LIBRARY_VERSION, self.db_update))
+            f.write(zlib.compress(body.encode('utf-8')))
+        os.replace(self._path + '.tmp', self._path)
+
+    def update(self, songs, removed, db_update=None):
+        # Without db_update the songs are one page of a sync still under
+        # way: they are indexed, but only saved once the sync completes.
+        for song in songs:
+            self._songs[song['file']] = song_record(song)
+        for uri in removed:
+            self._songs.pop(uri, None)
+        self._reindex()
+        if db_update is not None:
+            self.db_update = db_update
+            self.save()
+
+    def _reindex(self):
+        albums = {}
+        tracks = {}
+        for uri, (artist, album, disc, track, title) in self._songs.items():
+            albums.setdefault(artist, set()).add(album)
+            tracks.setdefault((artist, album), []).append((disc, track, title.casefold(), title, uri))
+        for key, entries in tracks.items():
+            entries.sort()
+            tracks[key] = ([entry[3] for entry in entries], [entry[4] for entry in entries])
+        self._index = (_sorted_names(albums), {artist: _sorted_names(names) for artist, names in albums.items()}, tracks)
+
+    def artists(self):
+        return self._index[0]
+
+    def albums(self, artist):
+        return self._index[1].get(artist, ([], []))
+
+    def tracks(self, artist, album):
+        return self._index[2].get((artist, album), ([], []))
+
+
+def draw_list(fb, font, names, cursor, placeholder):
+    # LIST_ROWS rows of the text area around the cursor, which is inverted.
+    fb.fill(0, 0, WIDTH, LIST_ROWS * FONT_SIZE, 0)
+    if not names:
+        fb.blit(0, FONT_SIZE, render_text(font, placeholder))
+        return
+    top = max(min(cursor - 1, len(names) - LIST_ROWS), 0)
+    for row, i in enumerate(range(top, min(top + LIST_ROWS, len(names)))):
+        bitmap = render_text(font, names[i])
+        if i == cursor:
+            bitmap = Bitmap(bitmap.width, bitmap.height, [p.translate(_INVERT_BITS) for p in bitmap.pages])
+        fb.blit(0, row * FONT_SIZE, bitmap, 0, WIDTH)
+
+
+class Browser:
+    # Artists, then their albums, then the tracks of an album, as a list in
+    # the text area with the cursor row inverted.
+    def __init__(self, fb, font, library):
+        self._fb = fb
+        self._font = font
+        self._library = library
+        self._path = []
+        self._cursors = [0]
+        self.failed = False
+
+    def _entries(self):
+        # Names and their sort keys; tracks are in album order, so they
+        # have no keys.
+        if not self._path:
+            return self._library.artists()
+        if len(self._path) == 1:
+            return self._library.albums(self._path[0])
+        return self._library.tracks(*self._path)[0], None
+
+    def _cursor(self, names):
+        cursor = min(self._cursors[-1], max(len(names) - 1, 0))
+        self._cursors[-1] = cursor
+        return cursor
 
-    def _keepalive(self):
-        self._mpd_controller.ping()
+    def draw(self):
+        names, _ = self._entries()
+        if len(self._library):
+            placeholder = '[Empty]'
+        else:
+            placeholder = '[Sync Failed]' if self.failed else '[Loading]'
+        draw_list(self._fb, self._font, names, self._cursor(names), placeholder)
+
+    def move(self, step):
+        names, _ = self._entries()
+        self._cursors[-1] = max(min(self._cursor(names) + step, len(names) - 1), 0)
+
+    def jump(self, direction):
+        names, keys = self._entries()
+        if not names:
+            return
+        cursor = self._cursor(names)
+        if keys is None:
+            self.move(direction * LIST_ROWS)
+        else:
+            self._cursors[-1] = prefix_jump(keys, cursor, direction)
+
+    def enter(self):
+        # Opens the entry under the cursor, or returns its file on a track.
+        names, _ = self._entries()
+        if not names:
+            return None
+        cursor = self._cursor(names)
+        if len(self._path) == 2:
+            return self._library.tracks(*self._path)[1][cursor]
+        self._path.append(names[cursor])
+        self._cursors.append(0)
+        return None
+
+    def leave(self):
+        if self._path:
+            self._path.pop()
+            self._cursors.pop()
+
+    def files(self):
+        names, _ = self._entries()
+        if not names:
+            return []
+        cursor = self._cursor(names)
+        if len(self._path) == 2:
+            return [self._library.tracks(*self._path)[1][cursor]]
+        if len(self._path) == 1:
+            return self._library.tracks(self._path[0], names[cursor])[1]
+        return [uri for album in self._library.albums(names[cursor])[0] for uri in self._library.tracks(names[cursor], album)[1]]
+
+
+class History:
+    # Songs played, kept in SQLite in WAL mode. Plays are collected on the
+    # loop and written in batches on an executor thread; each batch also
+    # bumps the per-artist counts in the same transaction, so the stats
+    # screen reads the top of an index and the newest rowids rather than
+    # scanning every play.
+    def __init__(self, path):
+        self._path = path
+        self._db = None
+        self._lock = threading.Lock()
+        self._pending = []
+
+    def _connect(self):
+        if self._db is None:
+            db = sqlite3.connect(self._path, check_same_thread=False)
+            db.executescript('''
+                    PRAGMA journal_mode = WAL;
+                    PRAGMA synchronous = NORMAL;
+                    CREATE TABLE IF NOT EXISTS plays (
+                            id INTEGER PRIMARY KEY,
+                            time REAL NOT NULL,
+                            file TEXT NOT NULL,
+                            artist TEXT NOT NULL,
+                            album TEXT NOT NULL,
+                            title TEXT NOT NULL,
+                            duration REAL NOT NULL
+                    );
+                    CREATE TABLE IF NOT EXISTS artists (
+                            artist TEXT PRIMARY KEY,
+                            plays INTEGER NOT NULL,
+                            last REAL NOT NULL
+                    );
+                    CREATE INDEX IF NOT EXISTS artists_plays ON artists (plays DESC, last DESC);
+            ''')
+            self._db = db
+        return self._db
+
+    def record(self, t, song):
+        self._pending.append((t, song['file'], song.get('artist', ''), song.get('album', ''), song.get('title', ''),
+                float(song.get('duration', 0))))
+
+    def pending(self):
+        return bool(self._pending)
+
+    def take(self):
+        batch = self._pending
+        self._pending = []
+        return batch
+
+    def write(self, batch):
+        with self._lock:
+            db = self._connect()
+            with db:
+                db.executemany('INSERT INTO plays (time, file, artist, album, title, duration) VALUES (?, ?, ?, ?, ?, ?)', batch)
+                db.executemany('INSERT INTO artists VALUES (?, 1, ?) ON CONFLICT (artist) DO UPDATE SET plays = plays + 1, last = excluded.last',
+                        [(play[2], play[0]) for play in batch])
+
+    def stats(self, limit):
+        # The most played artists and the latest plays, newest first.
+        with self._lock:
+            db = self._connect()
+            artists = db.execute('SELECT artist, plays FROM artists ORDER BY plays DESC, last DESC LIMIT ?', (limit,)).fetchall()
+            recent = db.execute('SELECT time, artist, title, file FROM plays ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+        return artists, recent
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+class StatsView:
+    # Top artists by plays, or the latest plays with their start time, as a
+    # list with the cursor row inverted. Select switches between the two.
+    def __init__(self, fb, font):
+        self._fb = fb
+        self._font = font
+        self._lists = None
+        self._cursors = [0, 0]
+        self.page = 0
+
+    def set_stats(self, artists, recent):
+        self._lists = (
+                ['%d %s' % (plays, artist or '[Unknown]') for artist, plays in artists],
+                [time.strftime('%H:%M ', time.localtime(t)) + (title or os.path.basename(uri)) for t, artist, title, uri in recent]
+        )
+        for page, names in enumerate(self._lists):
+            self._cursors[page] = max(min(self._cursors[page], len(names) - 1), 0)
 
+    def draw(self):
+        if self._lists is None:
+            draw_list(self._fb, self._font, (), 0, '[Loading]')
+            return
+        draw_list(self._fb, self._font, self._lists[self.page], self._cursors[self.page], '[No Plays]')
 
-    def _scroll_text(self, text):
-        if not self._event_term.is_set() and self._event_scroll.is_set():
-            self._lock.acquire()
-            text.scroll()
-            self._lock.release()
+    def move(self, step):
+        if self._lists is not None:
+            self._cursors[self.page] = max(min(self._cursors[self.page] + step, len(self._lists[self.page]) - 1), 0)
 
+    def toggle(self):
+        self.page = 1 - self.page
 
-    def _update_progress(self):
-        if not self._event_term.is_set() and self._event_update.is_set():
-            self._lock.acquire()
-            self._progress_bar.update()
-            self._lock.release()
 
+class QueueView:
+    # A window of the play queue around the cursor. Only the rows on screen
+    # are fetched and kept, the current song is marked and the cursor row
+    # inverted, and a row is redrawn only when any of that changes.
+    def __init__(self, fb, font):
+        self._fb = fb
+        self._font = font
+        self._rows = {}
+        self._drawn = [None] * LIST_ROWS
+        self._follow = True
+        self.version = None
+        self.length = 0
+        self.current = -1
+        self.cursor = 0
+
+    def window(self):
+        top = max(min(self.cursor - 1, self.length - LIST_ROWS), 0)
+        return top, min(top + LIST_ROWS, self.length)
+
+    def set_status(self, length, current):
+        # The cursor follows the current song until moved away from it.
+        self.length = length
+        if self._follow and current >= 0:
+            self.cursor = current
+        self.current = current
+        self.cursor = max(min(self.cursor, length - 1), 0)
+
+    def apply_changes(self, changes):
+        for pos, songid in changes:
+            row = self._rows.get(pos)
+            if row is not None and row[0] != songid:
+                del self._rows[pos]
+
+    def missing(self):
+        return [pos for pos in range(*self.window()) if pos not in self._rows]
+
+    def set_rows(self, songs):
+        for song in songs:
+            self._rows[int(song['pos'])] = (song['id'], song.get('title') or os.path.basename(song['file']))
+        start, end = self.window()
+        for pos in [pos for pos in self._rows if not start <= pos < end]:
+            del self._rows[pos]
+
+    def move(self, step):
+        self.cursor = max(min(self.cursor + step, self.length - 1), 0)
+        self._follow = self.cursor == self.current
+
+    def follow(self):
+        self._follow = True
+        if self.current >= 0:
+            self.cursor = self.current
 
-    def _update_elapsed(self):
-        if not self._event_term.is_set() and self._event_update.is_set():
-            self._lock.acquire()
-            self._time_elapsed.update()
+    def draw(self):
+        start, end = self.window()
+        for row in range(LIST_ROWS):
+            pos = start + row
+            if pos < end:
+                entry = self._rows.get(pos)
+                label = '%d %s' % (pos + 1, entry[1]) if entry is not None else str(pos + 1)
+                state = ('> ' + label if pos == self.current else label, pos == self.cursor)
+            elif row == 1 and not self.length:
+                state = ('[Empty]', False)
+            else:
+                state = None
+            if state == self._drawn[row]:
+                continue
+            self._drawn[row] = state
+            if state is None:
+                self._fb.fill(0, row * FONT_SIZE, WIDTH, FONT_SIZE, 0)
+                continue
+            bitmap = render_text(self._font, state[0])
+            if state[1]:
+                bitmap = Bitmap(bitmap.width, bitmap.height, [p.translate(_INVERT_BITS) for p in bitmap.pages])
+            self._fb.blit(0, row * FONT_SIZE, bitmap, 0, WIDTH)
+
+
+class CommandError(Exception):
+    pass
+
+
+def _quote(arg):
+    return '"' + str(arg).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _command_line(name, *args):
+    return ' '.join((name,) + tuple(_quote(arg) for arg in args))
+
+
+def parse_object(pairs):
+    obj = {}
+    for key, value in pairs:
+        obj.setdefault(key.lower(), value)
+    return obj
+
+
+def parse_songs(pairs):
+    songs = []
+    song = None
+    for key, value in pairs:
+        key = key.lower()
+        if key == 'file':
+            song = {'file': value}
+            songs.append(song)
+        elif key == 'directory' or key == 'playlist':
+            song = None
+        elif song is not None:
+            song.setdefault(key, value)
+    return songs
+
+
+class MPDConnection:
+    # Minimal asyncio implementation of the MPD protocol. python-mpd2's
+    # asyncio client has no command lists, which we need to fetch
+    # everything an idle event touches in a single round trip.
+    #
+    # One connection serves both the idle loop and commands: a command
+    # issued while idling sends noidle, waits for idle to return, and
+    # the idle loop queues up again behind it.
+    #
+    # The lock is created on the first connect: before Python 3.10 it binds
+    # to the loop current at construction, which may not be the one run.
+    def __init__(self):
+        self._reader = None
+        self._writer = None
+        self._lock = None
+        self._idling = False
+        self._waiting = 0
+        self.round_trips = 0
+        self.socket_time = 0.0
+
+    async def connect(self, host, port=MPD_PORT):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        if host.startswith('/'):
+            self._reader, self._writer = await asyncio.open_unix_connection(host)
+        else:
+            self._reader, self._writer = await asyncio.open_connection(host, port)
+        hello = await self._readline()
+        if not hello.startswith('OK MPD '):
+            self.disconnect()
+            raise ConnectionError('unexpected greeting: ' + hello)
+
+    def disconnect(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    async def _readline(self):
+        line = await self._reader.readline()
+        if not line.endswith(b'\n'):
+            self.disconnect()
+            raise ConnectionError('connection to MPD lost')
+        return line[:-1].decode('utf-8')
+
+    async def _read_pairs(self):
+        pairs = []
+        while True:
+            line = await self._readline()
+            if line == 'OK' or line == 'list_OK':
+                return pairs
+            if line.startswith('ACK '):
+                raise CommandError(line[4:])
+            key, _, value = line.partition(': ')
+            if key == 'binary':
+                # Raw bytes follow, terminated by a newline of their own.
+                try:
+                    value = (await self._reader.readexactly(int(value) + 1))[:-1]
+                except asyncio.IncompleteReadError:
+                    self.disconnect()
+                    raise ConnectionError('connection to MPD lost')
+            pairs.append((key, value))
+
+    def _check(self):
+        if self._writer is None:
+            raise ConnectionError('not connected to MPD')
+
+    async def _exchange(self, lines, count):
+        if self._lock is None:
+            raise ConnectionError('not connected to MPD')
+        if self._idling:
+            self._idling = False
+            self._writer.write(b'noidle\n')
+        t_wait = time.perf_counter()
+        self._waiting += 1
+        try:
+            await self._lock.acquire()
+        finally:
+            self._waiting -= 1
+        try:
+            self._check()
+            t = time.perf_counter()
+            metrics.lock_wait.observe(t - t_wait, 'mpd')
+            self._writer.write(''.join(line + '\n' for line in lines).encode('utf-8'))
+            try:
+                results = [await self._read_pairs() for _ in range(count)]
+                if len(lines) > count:
+                    # The list_OK of the last listed command is followed
+                    # by the OK closing the list.
+                    await self._read_pairs()
+            finally:
+                t = time.perf_counter() - t
+                self.round_trips += 1
+                self.socket_time += t
+                metrics.lock_hold.observe(t, 'mpd')
+                metrics.mpd_command.observe(t, lines[0].split(' ', 1)[0] if count == len(lines) else 'command_list')
+        finally:
             self._lock.release()
+        return results
+
+    async def command(self, name, *args):
+        return (await self._exchange([_command_line(name, *args)], 1))[0]
+
+    async def command_list(self, *commands):
+        lines = ['command_list_ok_begin']
+        lines.extend(_command_line(*c) for c in commands)
+        lines.append('command_list_end')
+        return await self._exchange(lines, len(commands))
+
+    async def idle(self, *subsystems):
+        # Returns an empty list when interrupted by a command, or right
+        # away when one is already waiting: it would have missed its
+        # chance to send noidle.
+        async with self._lock:
+            self._check()
+            if self._waiting:
+                return []
+            self._writer.write((_command_line('idle', *subsystems) + '\n').encode('utf-8'))
+            self._idling = True
+            try:
+                pairs = await self._read_pairs()
+            finally:
+                self._idling = False
+        return [value for key, value in pairs if key == 'changed']
 
 
-    def _alarm_handler(self, signum, frame):
-        backlight.set_all(*BACKLIGHT_OFF)
-        backlight.show()
-
-
-    def _termination_handler(self, signum, frame):
-        self._event_term.set()
-        self._mpd_monitor.disconnect()
-        self._mpd_controller.disconnect()
+class StagedSong:
+    # The frame a track change to songid would show, composed ahead of time
+    # so that the change itself is a single buffer swap.
+    def __init__(self, songid, texts, frame):
+        self.songid = songid
+        self.texts = texts
+        self.frame = frame
 
 
-    def _up_touch_handler(self, channel, event):
-        if event == 'press':
-            touch.set_led(channel, 1)
-            try:
-                self._mpd_controller.previous()
-            except CommandError:
-                pass
-        elif event == 'release':
-            touch.set_led(channel, 0)
+class MPC:
+    def __init__(self, display=None, fps=FRAME_RATE, host=MPD_SOCKET, port=MPD_PORT, font_path=FONT_PATH, atlas_path=ATLAS_PATH, metrics_path=None, fifo_path=None, art_cache_dir=ART_CACHE_DIR, library_path=LIBRARY_PATH, history_path=HISTORY_PATH, lyrics=False, music_dir=None, clock=time.monotonic):
+        if display is None:
+            display = GfxHatDisplay()
+        self._display = display
+        self._fb = FrameBuffer(display)
+        self._pages = Pages(self._fb)
+        self._fps = fps
+        self._font_path = font_path
+        self._atlas_path = atlas_path
+        self._compositor = None
+
+        self._host = host
+        self._port = port
+        self._mpd = MPDConnection()
 
+        self._current_songid = -1
+        self._staged = None
+        self.track_change_latency = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.event_cost = collections.deque(maxlen=LATENCY_SAMPLES)
+        self._metrics_path = metrics_path
+        self._metrics_server = None
+
+        self._loop = None
+        self._task_main = None
+        self._clock = clock
+        self._scheduler = Scheduler(clock=clock)
+        self._scroll_idx = 0
+        self._state = None
+        self._low_power = False
+        self._spectrum_path = fifo_path
+        self._spectrum = None
+        self._screen = 'player'
+        self._screens = ['player']
+        self._job_spectrum = None
+        self._song = {}
+        self._art_cache = ArtCache(art_cache_dir, ART_CACHE_SIZE)
+        self._art_page = None
+        self._art_key = None
+        self._art_missing = False
+        self._art_fetches = {}
+        self._library = Library(library_path)
+        self._library_loaded = None
+        self._library_task = None
+        self._browser = None
+        self._queue = None
+        self._queue_task = None
+        self._queue_stale = False
+        self._history = History(history_path)
+        self._history_timer = None
+        self._history_task = None
+        self._stats = None
+        self._lyrics_enabled = lyrics
+        self._music_dir = music_dir
+        self._lyrics_cache = LyricsCache(LYRICS_CACHE_SIZE)
+        self._lyrics = ([], [])
+        self._lyric = -1
+        self._lyrics_task = None
+        self._job_lyric = None
+        self._job_text = None
+        self._job_progress = None
+        self._job_elapsed = None
+        self._backlight_timer = None
+
+        self._commands = collections.deque()
+        self._commands_ready = None
+        self._task_commands = None
+        self._touch_pressed = [None] * 6
+        self._touch_released = [0] * 6
+        self._touch_repeat = [None] * 6
+        self.touch_latency = collections.deque(maxlen=LATENCY_SAMPLES)
+
+
+    def _scroll_text(self, t):
+        text = self._text_info[self._scroll_idx]
+        self._timed('text', text.scroll)
+        # Scrolling is cosmetic, so a late step is timed from now rather
+        # than caught up.
+        t = max(t, self._clock())
+        if text.is_scrolled():
+            return t + SCROLL_INTERVAL
+        self._scroll_idx = self._next_scrollable(self._scroll_idx + 1)
+        return t + SCROLL_DELAY
+
+
+    def _next_scrollable(self, idx):
+        for i in range(3):
+            if self._text_info[(idx + i) % 3].is_scrollable():
+                return (idx + i) % 3
+        return idx % 3
+
+
+    def _timed(self, widget, draw):
+        t = time.perf_counter()
+        draw()
+        metrics.render.observe(time.perf_counter() - t, widget)
+
+
+    def _next_progress(self):
+        self._t_progressed += self._progress_update_interval
+        if self._t_progressed > self._t_duration:
+            return None
+        return self._t_origin + self._t_progressed
+
+
+    def _update_progress(self, t):
+        self._timed('progress', self._progress_bar.update)
+        return self._next_progress()
+
+
+    def _next_elapsed(self):
+        self._t_elapsed += 1
+        if self._t_elapsed > self._t_duration:
+            return None
+        return self._t_origin + self._t_elapsed
+
+
+    def _update_elapsed(self, t):
+        self._timed('elapsed', self._time_elapsed.update)
+        return self._next_elapsed()
+
+
+    def _update_coarse(self, t):
+        self._timed('coarse', self._sync_position)
+        if self._t_elapsed >= self._t_duration:
+            return None
+        return max(t, self._clock()) + LOW_POWER_INTERVAL
+
+
+    def _sync_position(self):
+        t_elapsed = min(max(self._clock() - self._t_origin, 0), self._t_duration)
+        progress = int(t_elapsed / self._progress_update_interval)
+        self._t_elapsed = int(t_elapsed)
+        self._t_progressed = self._progress_update_interval * progress
+        self._progress_bar.set_progress(progress)
+        self._time_elapsed.set_time(t_elapsed)
+        self._progress_bar.draw()
+        self._time_elapsed.draw()
+        self._sync_lyric(t_elapsed)
+
+
+    def _start_updates(self):
+        if self._low_power:
+            self._job_progress = self._scheduler.schedule(self._clock() + LOW_POWER_INTERVAL, self._update_coarse, 'coarse')
+            self._start_lyrics()
+            return
+        t = self._next_progress()
+        if t is not None:
+            self._job_progress = self._scheduler.schedule(t, self._update_progress, 'progress')
+        t = self._next_elapsed()
+        if t is not None:
+            self._job_elapsed = self._scheduler.schedule(t, self._update_elapsed, 'elapsed')
+        self._start_lyrics()
+
+
+    def _load_lyrics(self, song):
+        # From a .lrc file next to the song, read on an executor thread
+        # unless it is cached.
+        self._lyrics = ([], [])
+        self._lyric = -1
+        if not self._lyrics_enabled or self._music_dir is None or not song:
+            return
+        path = os.path.splitext(os.path.join(self._music_dir, song['file']))[0] + '.lrc'
+        lyrics = self._lyrics_cache.get(path)
+        if lyrics is not None:
+            self._lyrics = lyrics
+        else:
+            self._lyrics_task = asyncio.create_task(self._fetch_lyrics(path, song['id']))
 
-    def _down_touch_handler(self, channel, event):
-        if event == 'press':
-            touch.set_led(channel, 1)
-            try:
-                self._mpd_controller.next()
-            except CommandError:
-                pass
-        elif event == 'release':
-            touch.set_led(channel, 0)
 
+    async def _fetch_lyrics(self, path, songid):
+        lyrics = await self._loop.run_in_executor(None, read_lrc, path)
+        self._lyrics_cache.put(path, lyrics)
+        if self._current_songid != songid:
+            return
+        self._lyrics = lyrics
+        if self._state == 'play':
+            self._start_lyrics()
 
-    def _back_touch_handler(self, channel, event):
-        if event == 'press':
-            touch.set_led(channel, 1)
-            self._mpd_controller.stop()
-        elif event == 'release':
-            touch.set_led(channel, 0)
 
+    def _start_lyrics(self):
+        # Each line change is a deadline of its own, like the elapsed time.
+        self._cancel_lyric()
+        self._sync_lyric(self._clock() - self._t_origin)
+        if self._low_power:
+            return
+        t = self._next_lyric()
+        if t is not None:
+            self._job_lyric = self._scheduler.schedule(t, self._update_lyric, 'lyric')
 
-    def _minus_touch_handler(self, channel, event):
-        if event == 'press':
-            touch.set_led(channel, 1)
-            try:
-                self._mpd_controller.seekcur('-5')
-            except CommandError:
-                pass
-        elif event == 'release':
-            touch.set_led(channel, 0)
 
+    def _sync_lyric(self, t_elapsed):
+        # After a seek the line is found by bisection. The album stays up
+        # until the first line.
+        times = self._lyrics[0]
+        if not times:
+            return
+        i = bisect.bisect_right(times, t_elapsed) - 1
+        if i != self._lyric:
+            self._lyric = i
+            self._show_lyric()
 
-    def _select_touch_handler(self, channel, event):
-        if event == 'press':
-            touch.set_led(channel, 1)
-            self._mpd_controller.pause()
-        elif event == 'release':
-            touch.set_led(channel, 0)
 
+    def _next_lyric(self):
+        times = self._lyrics[0]
+        if self._lyric + 1 >= len(times):
+            return None
+        return self._t_origin + times[self._lyric + 1]
 
-    def _plus_touch_handler(self, channel, event):
-        if event == 'press':
-            touch.set_led(channel, 1)
-            try:
-                self._mpd_controller.seekcur('+5')
-            except CommandError:
-                pass
-        elif event == 'release':
-            touch.set_led(channel, 0)
 
+    def _update_lyric(self, t):
+        self._lyric += 1
+        self._show_lyric()
+        return self._next_lyric()
 
-    def start(self):
-        uds_path = '/var/run/mpd/socket'
-        self._mpd_monitor.connect(uds_path)
-        self._mpd_controller.connect(uds_path)
 
-        self._thread_keepalive.start()
-        self._thread_text.start()
-        self._thread_progress.start()
-        self._thread_elapsed.start()
+    def _show_lyric(self):
+        text = self._text_info[2]
+        text.set_text(self._lyrics[1][self._lyric] if self._lyric >= 0 else song_texts(self._song)[2])
+        self._timed('text', text.draw)
+        if self._state == 'play':
+            self._start_scroll()
 
-        signal.signal(signal.SIGALRM, self._alarm_handler)
-        signal.signal(signal.SIGTERM, self._termination_handler)
 
-        font_dir = os.path.dirname(__file__)
-        font_path = os.path.join(font_dir, 'unifont-14.0.01.pcf')
-        font = ImageFont.truetype(font_path, FONT_SIZE)
+    def _start_scroll(self):
+        if self._low_power or self._job_text is not None:
+            return
+        if self._text_info[0].is_scrollable() or self._text_info[1].is_scrollable() or self._text_info[2].is_scrollable():
+            self._scroll_idx = self._next_scrollable(0)
+            self._job_text = self._scheduler.schedule(self._clock() + SCROLL_DELAY, self._scroll_text, 'scroll')
 
-        self._text_info = [
-                Text(0, font, '[Title]'),
-                Text(16, font, '[Artist]'),
-                Text(32, font, '[Album]')
-        ]
-        self._progress_bar = ProgressBar(49)
-        self._time_elapsed = Time(0, 57)
-        self._time_duration = Time(98, 57)
 
+    def _stop_scroll(self):
+        self._cancel_text()
         for text in self._text_info:
-            text.draw()
-        self._progress_bar.draw()
-        self._time_elapsed.draw()
-        self._time_duration.draw()
+            text.reset()
+
+
+    def _set_low_power(self, low_power):
+        # With the backlight off nobody is looking closely: scrolling stops
+        # and the elapsed time and progress bar are only resynced every
+        # LOW_POWER_INTERVAL. Leaving it redraws both from the clock.
+        if self._low_power == low_power:
+            return
+        self._low_power = low_power
+        if self._state != 'play':
+            return
+        self._sync_spectrum()
+        self._cancel_updates()
+        self._sync_position()
+        self._start_updates()
+        if low_power:
+            self._stop_scroll()
+        else:
+            self._start_scroll()
+
+
+    def _set_screen(self, screen):
+        # Every page is kept up to date while hidden, so switching draws
+        # nothing. Text only scrolls on the pages showing it: the player
+        # has all three lines, the spectrum the first two.
+        self._screen = screen
+        for text in self._text_info[:2]:
+            text.hidden = screen not in ('player', 'spectrum')
+        self._text_info[2].hidden = screen != 'player'
+        self._stop_scroll()
+        self._pages.switch(screen)
+        self._refresh_screen()
+        if self._state == 'play':
+            self._start_scroll()
+        self._sync_spectrum()
+
+
+    def _refresh_screen(self):
+        # Pages showing what the client does not hold are brought up to
+        # date while they are shown.
+        self._show_art()
+        if self._screen == 'queue':
+            self._refresh_queue_soon()
+        elif self._screen == 'stats':
+            self._sync_history_soon()
+
+
+    def _show_art(self):
+        # The art page follows the song while hidden as far as the cache
+        # goes; covers are only fetched while it is shown. The cache is
+        # read on an executor thread, keeping the SD card out of the
+        # track-change path.
+        if self._art_page is None:
+            return
+        key = art_key(self._song) if self._song else None
+        if key == self._art_key and not self._art_missing:
+            return
+        self._art_key = key
+        self._art_missing = False
+        self._art_page.fill(0, 0, WIDTH, ART_HEIGHT, 0)
+        if key is not None and key not in self._art_fetches:
+            self._art_fetches[key] = asyncio.create_task(self._load_art(key, self._song['file']))
+
+
+    async def _load_art(self, key, uri):
+        try:
+            data = await self._loop.run_in_executor(None, self._art_cache.get, key)
+            if data is None and self._screen == 'art' and self._art_key == key:
+                data = await self._fetch_art(key, uri)
+        except OSError:
+            return
+        finally:
+            del self._art_fetches[key]
+        if self._art_key != key:
+            return
+        if data is None:
+            self._art_missing = True
+        elif data:
+            self._art_page.blit(0, 0, Bitmap(WIDTH, ART_HEIGHT, [data[k * WIDTH:(k + 1) * WIDTH] for k in range(ART_HEIGHT // 8)]))
+        else:
+            self._art_page.blit(0, 16, render_text(self._font, '[No Art]'))
 
-        lcd.show()
 
+    async def _read_picture(self, key, uri):
+        # Embedded pictures first, then cover files next to the song. Every
+        # chunk is its own command, so the connection is free in between
+        # and a fetch for an album no longer shown stops there.
+        for command in ('readpicture', 'albumart'):
+            chunks = []
+            offset = 0
+            while True:
+                if self._art_key != key:
+                    return None
+                try:
+                    obj = parse_object(await self._mpd.command(command, uri, offset))
+                except CommandError:
+                    break
+                chunk = obj.get('binary')
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                offset += len(chunk)
+                if offset >= int(obj['size']):
+                    return b''.join(chunks)
+        return b''
+
+
+    async def _fetch_art(self, key, uri):
+        data = await self._read_picture(key, uri)
+        if data is None:
+            return None
+        return await self._loop.run_in_executor(None, self._store_art, key, data)
+
+
+    def _store_art(self, key, data):
+        # Runs on an executor thread: decoding, dithering and the cache
+        # write with its eviction pass.
+        if data:
+            data = render_art(data)
+        self._art_cache.put(key, data)
+        return data
+
+
+    def _sync_spectrum(self):
+        running = self._screen == 'spectrum' and self._state == 'play' and not self._low_power
+        if running and self._job_spectrum is None:
+            self._spectrum.open()
+            self._job_spectrum = self._scheduler.schedule(self._clock(), self._update_spectrum, 'spectrum')
+        elif not running and self._job_spectrum is not None:
+            self._scheduler.cancel(self._job_spectrum)
+            self._job_spectrum = None
+            self._spectrum.close()
+            self._spectrum.draw()
+
+
+    def _update_spectrum(self, t):
+        self._timed('spectrum', self._spectrum.update)
+        t += self._spectrum.interval()
+        now = self._clock()
+        if t < now:
+            # Frames that are already late are dropped, not drawn back to back.
+            missed = int((now - t) / self._spectrum.interval()) + 1
+            self._spectrum.dropped += missed
+            t += missed * self._spectrum.interval()
+        return t
+
+
+    def _cancel_text(self):
+        if self._job_text is not None:
+            self._scheduler.cancel(self._job_text)
+            self._job_text = None
+
+
+    def _cancel_updates(self):
+        if self._job_progress is not None:
+            self._scheduler.cancel(self._job_progress)
+            self._job_progress = None
+        if self._job_elapsed is not None:
+            self._scheduler.cancel(self._job_elapsed)
+            self._job_elapsed = None
+        self._cancel_lyric()
+
+
+    def _cancel_lyric(self):
+        if self._job_lyric is not None:
+            self._scheduler.cancel(self._job_lyric)
+            self._job_lyric = None
+
+
+    def _sync_library_soon(self):
+        if self._library_task is None or self._library_task.done():
+            self._library_task = asyncio.create_task(self._sync_library())
+
+
+    async def _sync_library(self):
+        # The first sync lists the whole database; later ones fetch songs
+        # with newer modification times and diff the file list for
+        # additions and removals. Listings go over a connection of their
+        # own so they never hold up the idle loop, and rebuilding the
+        # sorted lists and saving them runs on an executor thread.
+        #
+        # MPD drops a client whose response outgrows its output buffer, so
+        # the first listing comes in windows of LIBRARY_PAGE songs, each
+        # merged into the index as it arrives. The index is only saved
+        # with its db_update once the last one is in.
+        await self._library_loaded
+        # The page was first drawn while the saved index was still loading.
+        self._timed('browser', self._browser.draw)
+        mpd = MPDConnection()
+        try:
+            await mpd.connect(self._host, self._port)
+            while True:
+                db_update = int(parse_object(await mpd.command('stats')).get('db_update', 0))
+                if db_update == self._library.db_update:
+                    return
+                if not self._library.db_update:
+                    # Songs left over from an interrupted listing are
+                    # dropped unless they turn up again.
+                    listed = set()
+                    start = 0
+                    while True:
+                        songs = parse_songs(await mpd.command('find', '(modified-since "0")', 'window', '%d:%d' % (start, start + LIBRARY_PAGE)))
+                        listed.update(song['file'] for song in songs)
+                        if len(songs) < LIBRARY_PAGE:
+                            break
+                        await self._loop.run_in_executor(None, self._library.update, songs, ())
+                        self._timed('browser', self._browser.draw)
+                        start += LIBRARY_PAGE
+                    removed = set(self._library.files()) - listed
+                else:
+                    songs = parse_songs(await mpd.command('find', '(modified-since "%d")' % self._library.db_update))
+                    files = set(value for key, value in await mpd.command('listall') if key == 'file')
+                    known = set(self._library.files())
+                    added = files - known - set(song['file'] for song in songs)
+                    if added:
+                        for pairs in await mpd.command_list(*(('lsinfo', uri) for uri in added)):
+                            songs.extend(parse_songs(pairs))
+                    removed = known - files
+                await self._loop.run_in_executor(None, self._library.update, songs, removed, db_update)
+                self._browser.failed = False
+                self._timed('browser', self._browser.draw)
+        except (CommandError, OSError):
+            # Retried on the next database event.
+            self._browser.failed = True
+            self._timed('browser', self._browser.draw)
+        finally:
+            mpd.disconnect()
+
+
+    def _refresh_queue_soon(self):
+        self._queue_stale = True
+        if self._queue_task is None or self._queue_task.done():
+            self._queue_task = asyncio.create_task(self._refresh_queue())
+
+
+    async def _refresh_queue(self):
+        # Edits by other clients come back from plchangesposid as the
+        # positions in the window whose song changed; only those rows and
+        # rows scrolled into view are fetched, with one ranged playlistinfo.
+        view = self._queue
+        try:
+            while self._queue_stale and self._screen == 'queue':
+                self._queue_stale = False
+                status = parse_object(await self._mpd.command('status'))
+                version = int(status['playlist'])
+                view.set_status(int(status['playlistlength']), int(status.get('song', -1)))
+                start, end = view.window()
+                if view.version is not None and view.version != version and start < end:
+                    changes = await self._mpd.command('plchangesposid', view.version, '%d:%d' % (start, end))
+                    view.apply_changes(zip((int(value) for key, value in changes if key == 'cpos'),
+                            (value for key, value in changes if key == 'Id')))
+                view.version = version
+                missing = view.missing()
+                if missing:
+                    view.set_rows(parse_songs(await self._mpd.command('playlistinfo', '%d:%d' % (missing[0], missing[-1] + 1))))
+                self._timed('queue', view.draw)
+        except (CommandError, ConnectionError):
+            pass
+
+
+    def _browse_queue(self, channel, t):
+        view = self._queue
+        if channel == TOUCH_UP:
+            view.move(-1)
+        elif channel == TOUCH_DOWN:
+            view.move(1)
+        elif TOUCH_SEEK_DIRECTION[channel]:
+            view.move(TOUCH_SEEK_DIRECTION[channel] * LIST_ROWS)
+        elif channel == TOUCH_SCREEN:
+            view.follow()
+        elif channel == TOUCH_SELECT and view.length:
+            self._queue_command(t, 'play', (view.cursor,))
+        self._timed('queue', view.draw)
+        self._refresh_queue_soon()
+
+
+    def _record_play(self, song):
+        # Plays are written every HISTORY_FLUSH_DELAY, or straight away
+        # while the stats screen is up.
+        self._history.record(time.time(), song)
+        if self._screen == 'stats':
+            self._sync_history_soon()
+        elif self._history_timer is None:
+            self._history_timer = self._loop.call_later(HISTORY_FLUSH_DELAY, self._sync_history_soon)
+
+
+    def _sync_history_soon(self):
+        if self._history_timer is not None:
+            self._history_timer.cancel()
+            self._history_timer = None
+        if self._history_task is None or self._history_task.done():
+            self._history_task = asyncio.create_task(self._sync_history())
+
+
+    async def _sync_history(self):
+        # Plays recorded while a batch is being written go out with the
+        # next one. The stats are read back after the writes, so they
+        # include every play so far.
+        try:
+            while True:
+                if self._history.pending():
+                    await self._loop.run_in_executor(None, self._history.write, self._history.take())
+                if self._screen == 'stats':
+                    stats = await self._loop.run_in_executor(None, self._history.stats, HISTORY_ROWS)
+                    if self._screen == 'stats':
+                        self._stats.set_stats(*stats)
+                        self._timed('stats', self._stats.draw)
+                if not self._history.pending():
+                    return
+        except sqlite3.Error:
+            pass
+
+
+    def _browse_stats(self, channel):
+        stats = self._stats
+        if channel == TOUCH_UP:
+            stats.move(-1)
+        elif channel == TOUCH_DOWN:
+            stats.move(1)
+        elif TOUCH_SEEK_DIRECTION[channel]:
+            stats.move(TOUCH_SEEK_DIRECTION[channel] * LIST_ROWS)
+        elif channel == TOUCH_SELECT:
+            stats.toggle()
+        self._timed('stats', stats.draw)
+
+
+    def _browse(self, channel, t):
+        browser = self._browser
+        if channel == TOUCH_UP:
+            browser.move(-1)
+        elif channel == TOUCH_DOWN:
+            browser.move(1)
+        elif TOUCH_SEEK_DIRECTION[channel]:
+            browser.jump(TOUCH_SEEK_DIRECTION[channel])
+        elif channel == TOUCH_SCREEN:
+            browser.leave()
+        elif channel == TOUCH_SELECT:
+            uri = browser.enter()
+            if uri is not None:
+                self._queue_command(t, 'addid', (uri,))
+        self._timed('browser', browser.draw)
+
+
+    async def _stage_next(self, status):
+        try:
+            songid = status['nextsongid']
+        except KeyError:
+            self._staged = None
+            return
+        if self._staged is not None and self._staged.songid == songid:
+            return
+        try:
+            song = parse_object(await self._mpd.command('playlistid', songid))
+        except CommandError:
+            self._staged = None
+            return
+        texts = song_texts(song)
+        scratch = FrameBuffer(None)
+        scratch.load(self._pages.page('player').buf)
+        for y, t in zip((0, 16, 32), texts):
+            Text(scratch, y, self._font, t).draw()
+        ProgressBar(scratch, 49).draw()
+        Time(scratch, 0, 57).draw()
+        duration = Time(scratch, 98, 57)
+        duration.set_time(float(song.get('duration', 0)))
+        duration.draw()
+        self._staged = StagedSong(songid, texts, scratch.buf)
+
+
+    def _backlight_on(self):
         backlight.set_all(*BACKLIGHT_COLOR)
         backlight.show()
-        signal.alarm(BACKLIGHT_TIMEOUT)
+        if self._backlight_timer is not None:
+            self._backlight_timer.cancel()
+        self._backlight_timer = self._loop.call_later(BACKLIGHT_TIMEOUT, self._backlight_off)
+        self._set_low_power(False)
 
-        try:
-            while True:
-                self._mpd_monitor.idle('player')
 
-                t_current = time.time()
+    def _backlight_off(self):
+        backlight.set_all(*BACKLIGHT_OFF)
+        backlight.show()
+        self._set_low_power(True)
 
-                backlight.set_all(*BACKLIGHT_COLOR)
-                backlight.show()
-                signal.alarm(BACKLIGHT_TIMEOUT)
 
-                status = self._mpd_monitor.status()
-                state = status['state']
-                if state == 'play':
-                    self._event_cancel.set()
-                    self._event_update.clear()
-                    try:
-                        self._scheduler_progress.cancel(self._waiting_progress)
-                    except ValueError:
-                        pass
-                    try:
-                        self._scheduler_elapsed.cancel(self._waiting_elapsed)
-                    except ValueError:
-                        pass
+    def _termination_handler(self):
+        self._task_main.cancel()
 
-                    songid = status['songid']
-                    if self._current_songid != songid:
-                        self._event_scroll.clear()
-                        try:
-                            self._scheduler_text.cancel(self._waiting_text)
-                        except ValueError:
-                            pass
-
-                        self._current_songid = songid
-                        current_song = self._mpd_monitor.currentsong()
-                        try:
-                            title = current_song['title']
-                        except KeyError:
-                            title = '-'
-
-                        try:
-                            artist = current_song['artist']
-                        except KeyError:
-                            artist = '-'
-
-                        try:
-                            album = current_song['album']
-                        except KeyError:
-                            album = '-'
-
-                        self._text_info[0].set_text(title)
-                        self._text_info[1].set_text(artist)
-                        self._text_info[2].set_text(album)
-                        self._t_duration = float(status['duration'])
-                        self._progress_update_interval = self._t_duration / (WIDTH - 2)
-                        self._time_duration.set_time(self._t_duration)
-
-                        for text in self._text_info:
-                            text.draw()
-                        self._time_duration.draw()
-
-                        if self._text_info[0].is_scrollable() or self._text_info[1].is_scrollable() or self._text_info[2].is_scrollable():
-                            self._event_scroll.set()
-
-                        touch.on(0, self._up_touch_handler)
-                        touch.on(1, self._down_touch_handler)
-                        touch.on(2, self._back_touch_handler)
-                        touch.on(3, self._minus_touch_handler)
-                        touch.on(4, self._select_touch_handler)
-                        touch.on(5, self._plus_touch_handler)
-
-                    t_elapsed = float(status['elapsed'])
-                    progress = int(t_elapsed / self._progress_update_interval)
-
-                    self._t_origin = t_current - t_elapsed
-                    self._t_elapsed = int(t_elapsed)
-                    self._t_progressed = self._progress_update_interval * progress
-
-                    self._progress_bar.set_progress(progress)
-                    self._time_elapsed.set_time(t_elapsed)
-
-                    self._progress_bar.draw()
-                    self._time_elapsed.draw()
-
-                    lcd.show()
-
-                    self._event_cancel.clear()
-                    self._event_update.set()
-                elif state == 'pause':
-                    self._event_cancel.set()
-                    self._event_update.clear()
-                    try:
-                        self._scheduler_progress.cancel(self._waiting_progress)
-                    except ValueError:
-                        pass
-                    try:
-                        self._scheduler_elapsed.cancel(self._waiting_elapsed)
-                    except ValueError:
-                        pass
 
-                    self._event_cancel.clear()
+    def _touch_handler(self, channel, event):
+        # Runs on the cap1xxx polling thread: the LED follows the finger
+        # right away, everything else happens on the loop.
+        if event == 'press':
+            touch.set_led(channel, 1)
+        elif event == 'release':
+            touch.set_led(channel, 0)
+        else:
+            return
+        self._loop.call_soon_threadsafe(self._on_touch, channel, event, self._clock())
 
-                elif state == 'stop':
-                    self._event_cancel.set()
-                    self._event_scroll.clear()
-                    self._event_update.clear()
-                    try:
-                        self._scheduler_text.cancel(self._waiting_text)
-                    except ValueError:
-                        pass
-                    try:
-                        self._scheduler_progress.cancel(self._waiting_progress)
-                    except ValueError:
-                        pass
+
+    def _on_touch(self, channel, event, t):
+        if event == 'press':
+            if self._touch_pressed[channel] is not None or t - self._touch_released[channel] < TOUCH_DEBOUNCE:
+                return
+            self._touch_pressed[channel] = t
+            self._backlight_on()
+            if self._is_held(channel):
+                # Holding the pad does something else, so its tap waits
+                # for the release.
+                self._touch_repeat[channel] = self._loop.call_later(TOUCH_HOLD_DELAY, self._hold, channel, t)
+                return
+            self._press(channel, t, 0)
+            if TOUCH_SEEK_DIRECTION[channel] or self._screen in ('library', 'queue', 'stats') and channel in (TOUCH_UP, TOUCH_DOWN):
+                self._touch_repeat[channel] = self._loop.call_later(TOUCH_HOLD_DELAY, self._repeat, channel, 1)
+        else:
+            t_press = self._touch_pressed[channel]
+            if t_press is None:
+                return
+            self._touch_pressed[channel] = None
+            self._touch_released[channel] = t
+            if self._touch_repeat[channel] is not None:
+                self._touch_repeat[channel].cancel()
+                self._touch_repeat[channel] = None
+                if self._is_held(channel):
+                    self._press(channel, t_press, 0)
+
+
+    def _is_held(self, channel):
+        # Holding back switches screens, holding select in the library
+        # queues the whole entry under the cursor.
+        if channel == TOUCH_SCREEN:
+            return len(self._screens) > 1
+        return channel == TOUCH_SELECT and self._screen == 'library'
+
+
+    def _hold(self, channel, t):
+        self._touch_repeat[channel] = None
+        if channel == TOUCH_SCREEN:
+            self._set_screen(self._screens[(self._screens.index(self._screen) + 1) % len(self._screens)])
+        else:
+            files = self._browser.files()
+            if files:
+                self._queue_command(t, 'add', files)
+
+
+    def _repeat(self, channel, count):
+        self._press(channel, self._clock(), count)
+        self._touch_repeat[channel] = self._loop.call_later(TOUCH_REPEAT_INTERVAL, self._repeat, channel, count + 1)
+
+
+    def _press(self, channel, t, count):
+        if self._screen == 'library':
+            self._browse(channel, t)
+            return
+        if self._screen == 'queue':
+            self._browse_queue(channel, t)
+            return
+        if self._screen == 'stats':
+            self._browse_stats(channel)
+            return
+        command = TOUCH_COMMANDS[channel]
+        direction = TOUCH_SEEK_DIRECTION[channel]
+        if not direction:
+            self._queue_command(t, command, ())
+            return
+        # Holding a seek button speeds it up every SEEK_ACCELERATE repeats.
+        step = min(SEEK_STEP * (1 + count // SEEK_ACCELERATE), SEEK_STEP_MAX)
+        last = self._commands[-1] if self._commands else None
+        if last is not None and last[1] == command:
+            # A seek still waiting for the connection absorbs this one.
+            last[2] = (last[2][0] + direction * step,)
+            return
+        self._queue_command(t, command, (direction * step,))
+
+
+    def _queue_command(self, t, command, args):
+        self._commands.append([t, command, args])
+        self._commands_ready.set()
+
+
+    async def _dispatch_commands(self):
+        while True:
+            if not self._commands:
+                self._commands_ready.clear()
+                await self._commands_ready.wait()
+            t, command, args = self._commands.popleft()
+            if command == 'seekcur':
+                if not args[0]:
+                    continue
+                args = ('%+d' % args[0],)
+            try:
+                if command == 'add':
+                    # A whole artist or album goes out as one command list.
+                    await self._mpd.command_list(*(('add', uri) for uri in args))
+                else:
+                    result = await self._mpd.command(command, *args)
+                    if command == 'addid':
+                        await self._mpd.command('playid', parse_object(result)['id'])
+            except (CommandError, ConnectionError):
+                continue
+            self.touch_latency.append(self._clock() - t)
+            metrics.touch_command.observe(self.touch_latency[-1], command)
+
+
+    async def _on_idle(self, changed):
+        t_current = self._clock()
+        round_trips = self._mpd.round_trips
+        socket_time = self._mpd.socket_time
+
+        if 'database' in changed:
+            self._sync_library_soon()
+            if len(changed) == 1:
+                return
+
+        if 'player' in changed:
+            status, song = await self._mpd.command_list(('status',), ('currentsong',))
+            # Elapsed was sampled before the reply, never after it, so the
+            # digits never run ahead of it.
+            t_status = self._clock()
+            status = parse_object(status)
+            song = parse_object(song)
+        else:
+            status = parse_object(await self._mpd.command('status'))
+
+        if 'player' in changed or 'mixer' in changed or 'options' in changed:
+            self._backlight_on()
+
+        if 'mixer' in changed and status.get('volume', '-1') != '-1':
+            self._volume_text.set_text('Volume %s%%' % status['volume'])
+            self._volume_bar.set_progress(int(status['volume']) * (WIDTH - 2) // 100)
+            self._timed('volume', self._volume_text.draw)
+            self._timed('volume', self._volume_bar.draw)
+            self._pages.show_overlay('volume', VOLUME_TIMEOUT)
+
+        if 'options' in changed:
+            self._indicators.set_options(status)
+            self._timed('indicators', self._indicators.draw)
+
+        if self._screen == 'queue' and ('playlist' in changed or 'player' in changed):
+            self._refresh_queue_soon()
+
+        if 'player' in changed:
+            await self._on_player(t_current, t_status, status, song)
+        elif 'playlist' in changed:
+            # The queue was edited: whatever follows the current song may
+            # be a different track now.
+            self._staged = None
+            if status['state'] == 'play':
+                await self._stage_next(status)
+
+        self.event_cost.append((self._mpd.round_trips - round_trips, self._mpd.socket_time - socket_time))
+        metrics.event_round_trips.observe(self.event_cost[-1][0])
+        metrics.event_socket.observe(self.event_cost[-1][1])
+
+
+    async def _on_player(self, t_current, t_status, status, song):
+        state = status['state']
+        self._state = state
+        if state == 'play':
+            t_render = time.perf_counter()
+            self._cancel_updates()
+
+            songid = status['songid']
+            changed = self._current_songid != songid
+            if changed:
+                self._cancel_text()
+
+                self._current_songid = songid
+                staged = self._staged
+                if staged is not None and staged.songid == songid:
+                    texts = staged.texts
+                else:
+                    staged = None
+                    texts = song_texts(song)
+
+                for text, t in zip(self._text_info, texts):
+                    text.set_text(t)
+                self._t_duration = float(status['duration'])
+                self._progress_update_interval = self._t_duration / (WIDTH - 2)
+                self._time_duration.set_time(self._t_duration)
+
+                if staged is not None:
+                    # The player page takes the staged frame whole, so the
+                    # lines drawn next only reach the other pages.
+                    self._pages.page('player').load(staged.frame)
+                    self._indicators.draw()
+                for text in self._text_info:
+                    text.draw()
+                self._song = song
+                self._load_lyrics(song)
+                self._record_play(song)
+                self._refresh_screen()
+                self._time_duration.draw()
+
+            t_elapsed = float(status['elapsed'])
+            progress = int(t_elapsed / self._progress_update_interval)
+
+            self._t_origin = t_status - t_elapsed
+            self._t_elapsed = int(t_elapsed)
+            self._t_progressed = self._progress_update_interval * progress
+
+            self._progress_bar.set_progress(progress)
+            self._time_elapsed.set_time(t_elapsed)
+
+            self._progress_bar.draw()
+            self._time_elapsed.draw()
+            metrics.render.observe(time.perf_counter() - t_render, 'player')
+
+            await self._compositor.frame()
+            if changed:
+                self.track_change_latency.append(self._clock() - t_current)
+                metrics.track_change.observe(self.track_change_latency[-1])
+
+            self._start_updates()
+            self._start_scroll()
+
+            await self._stage_next(status)
+        elif state == 'pause':
+            self._cancel_updates()
+            self._stop_scroll()
+
+        elif state == 'stop':
+            self._cancel_text()
+            self._cancel_updates()
+
+            self._current_songid = -1
+            self._song = {}
+            self._load_lyrics(self._song)
+
+            self._text_info[0].set_text('[Title]')
+            self._text_info[1].set_text('[Artist]')
+            self._text_info[2].set_text('[Album]')
+            self._progress_bar.set_progress(0)
+            self._time_elapsed.set_time(0)
+            self._time_duration.set_time(0)
+
+            for text in self._text_info:
+                text.draw()
+            self._progress_bar.draw()
+            self._time_elapsed.draw()
+            self._time_duration.draw()
+            self._refresh_screen()
+
+        self._sync_spectrum()
+
+
+    def _metrics_text(self):
+        lines = metrics.exposition()
+        cache = text_cache.stats()
+        lines.extend((
+                '# HELP gfxmpc_display_bytes_total Bytes sent to the display controller.',
+                '# TYPE gfxmpc_display_bytes_total counter',
+                'gfxmpc_display_bytes_total %d' % self._display.pushed.total,
+                '# HELP gfxmpc_flushes_total Frames pushed to the display.',
+                '# TYPE gfxmpc_flushes_total counter',
+                'gfxmpc_flushes_total %d' % self._compositor.flushes.total,
+                '# HELP gfxmpc_mpd_round_trips_total Requests sent to MPD, excluding idle.',
+                '# TYPE gfxmpc_mpd_round_trips_total counter',
+                'gfxmpc_mpd_round_trips_total %d' % self._mpd.round_trips,
+                '# HELP gfxmpc_text_cache_bytes Bytes held by the rendered text cache.',
+                '# TYPE gfxmpc_text_cache_bytes gauge',
+                'gfxmpc_text_cache_bytes %d' % cache['bytes'],
+                '# HELP gfxmpc_text_cache_lookups_total Rendered text cache lookups.',
+                '# TYPE gfxmpc_text_cache_lookups_total counter',
+                'gfxmpc_text_cache_lookups_total{result="hit"} %d' % cache['hits'],
+                'gfxmpc_text_cache_lookups_total{result="miss"} %d' % cache['misses']
+        ))
+        return '\n'.join(lines) + '\n'
+
+
+    async def _serve_metrics(self, reader, writer):
+        # Just enough HTTP for `curl --unix-socket`; the request itself is
+        # ignored and every request gets the full exposition.
+        try:
+            while (await reader.readline()).strip():
+                pass
+            body = self._metrics_text().encode('utf-8')
+            writer.write(b'HTTP/1.0 200 OK\r\n'
+                         b'Content-Type: text/plain; version=0.0.4\r\n'
+                         b'Content-Length: %d\r\n\r\n' % len(body) + body)
+            await writer.drain()
+        except OSError:
+            pass
+        finally:
+            writer.close()
+
+
+    async def _serve(self):
+        delay = RECONNECT_DELAY
+        while True:
+            try:
+                await self._mpd.connect(self._host, self._port)
+                try:
+                    await self._mpd.command('binarylimit', ART_BINARY_LIMIT)
+                except CommandError:
+                    pass
+                if self._lyrics_enabled and self._music_dir is None:
+                    # MPD only tells clients on its local socket.
                     try:
-                        self._scheduler_elapsed.cancel(self._waiting_elapsed)
-                    except ValueError:
+                        self._music_dir = parse_object(await self._mpd.command('config')).get('music_directory')
+                    except CommandError:
                         pass
+                self._sync_library_soon()
+                # The screen under the overlay was left as it was, so a
+                # short MPD restart costs no re-rendering.
+                self._pages.hide_overlay('disconnected')
+                self._staged = None
+                await self._on_idle(('player', 'options', 'playlist'))
+                delay = RECONNECT_DELAY
+                while True:
+                    changed = await self._mpd.idle(*IDLE_SUBSYSTEMS)
+                    if changed:
+                        await self._on_idle(changed)
+            except OSError:
+                self._mpd.disconnect()
+                self._state = None
+                self._sync_spectrum()
+                self._cancel_text()
+                self._cancel_updates()
+                self._pages.show_overlay('disconnected')
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_DELAY_MAX)
+
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._task_main = asyncio.current_task()
+        self._loop.add_signal_handler(signal.SIGTERM, self._termination_handler)
+
+        self._compositor = Compositor(self._pages, self._fps)
+
+        if self._metrics_path is not None:
+            if os.path.exists(self._metrics_path):
+                os.unlink(self._metrics_path)
+            self._metrics_server = await asyncio.start_unix_server(self._serve_metrics, self._metrics_path)
+
+        self._font = GlyphAtlas.open(self._font_path, self._atlas_path)
+
+        if self._spectrum_path is not None and import_numpy():
+            self._screens.append('spectrum')
+        if importlib.util.find_spec('PIL') is not None:
+            self._screens.append('art')
+        self._screens.extend(('library', 'queue', 'stats'))
+        pages = self._pages
+        for screen in self._screens:
+            pages.add(screen)
+
+        # Widgets on more than one screen draw into all of their pages.
+        self._text_info = [
+                Text(pages.view('player', 'spectrum'), 0, self._font, '[Title]'),
+                Text(pages.view('player', 'spectrum'), 16, self._font, '[Artist]'),
+                Text(pages.page('player'), 32, self._font, '[Album]')
+        ]
+        self._progress_bar = ProgressBar(pages.view(*(screen for screen in self._screens if screen != 'spectrum')), 49)
+        self._time_elapsed = Time(pages.view(*self._screens), 0, 57)
+        self._time_duration = Time(pages.view(*self._screens), 98, 57)
+        self._indicators = Indicators(pages.view(*self._screens), 52, 57)
+        if 'spectrum' in self._screens:
+            self._spectrum = Spectrum(pages.page('spectrum'), SPECTRUM_Y, self._spectrum_path)
+        if 'art' in self._screens:
+            self._art_page = pages.page('art')
+        self._browser = Browser(pages.page('library'), self._font, self._library)
+        self._queue = QueueView(pages.page('queue'), self._font)
+        self._stats = StatsView(pages.page('stats'), self._font)
+        self._library_loaded = self._loop.run_in_executor(None, self._library.load)
+
+        volume = pages.add('volume')
+        self._volume_text = Text(volume, 16, self._font, '')
+        self._volume_bar = ProgressBar(volume, 40)
+        Text(pages.add('disconnected'), 24, self._font, '[Disconnected]').draw()
+        pages.add('blank')
 
-                    self._current_songid = -1
-
-                    self._text_info[0].set_text('[Title]')
-                    self._text_info[1].set_text('[Artist]')
-                    self._text_info[2].set_text('[Album]')
-                    self._progress_bar.set_progress(0)
-                    self._time_elapsed.set_time(0)
-                    self._time_duration.set_time(0)
-
-                    for text in self._text_info:
-                        text.draw()
-                    self._progress_bar.draw()
-                    self._time_elapsed.draw()
-                    self._time_duration.draw()
+        for text in self._text_info:
+            text.draw()
+        self._progress_bar.draw()
+        self._time_elapsed.draw()
+        self._time_duration.draw()
+        self._indicators.draw()
+        self._browser.draw()
+        self._queue.draw()
+        self._stats.draw()
 
-                    lcd.show()
+        # The placeholder layout goes out before MPD is even connected.
+        self._compositor.flush()
 
-                    touch._cap1166.stop_watching()
+        self._backlight_on()
 
-                    self._event_cancel.clear()
+        # Repeats are timed here rather than by the controller, so that
+        # held seeks can speed up.
+        touch.enable_repeat(False)
+        # Created on the running loop, for Python before 3.10.
+        self._commands_ready = asyncio.Event()
+        for ch in range(6):
+            touch.on(ch, self._touch_handler)
+        self._task_commands = asyncio.create_task(self._dispatch_commands())
 
-        except RuntimeError:
-            self._event_cancel.set()
-            try:
-                self._scheduler_keepalive.cancel(self._waiting_keepalive)
-            except ValueError:
-                pass
-            try:
-                self._scheduler_text.cancel(self._waiting_text)
-            except ValueError:
-                pass
-            try:
-                self._scheduler_progress.cancel(self._waiting_progress)
-            except ValueError:
-                pass
+        try:
+            await self._serve()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            if touch._cap1166 is not None:
+                touch._cap1166.stop_watching()
+            self._task_commands.cancel()
+            for task in self._art_fetches.values():
+                task.cancel()
+            if self._library_task is not None:
+                self._library_task.cancel()
+            if self._queue_task is not None:
+                self._queue_task.cancel()
+            if self._history_timer is not None:
+                self._history_timer.cancel()
+            if self._history_task is not None:
+                self._history_task.cancel()
+            if self._lyrics_task is not None:
+                self._lyrics_task.cancel()
+            for timer in self._touch_repeat:
+                if timer is not None:
+                    timer.cancel()
+
+            # Everything below runs on the loop thread, so no timer can
+            # touch the display once the scheduler is closed.
+            self._state = None
+            self._scheduler.close()
+            if self._spectrum is not None:
+                self._spectrum.close()
+            if self._backlight_timer is not None:
+                self._backlight_timer.cancel()
+
+            self._mpd.disconnect()
+            # Plays not yet written go out now, after any batch still being
+            # written on the executor.
             try:
-                self._scheduler_elapsed.cancel(self._waiting_elapsed)
-            except ValueError:
+                if self._history.pending():
+                    self._history.write(self._history.take())
+            except sqlite3.Error:
                 pass
+            self._history.close()
+            if self._metrics_server is not None:
+                self._metrics_server.close()
+                os.unlink(self._metrics_path)
 
-            self._event_scroll.set()
-            self._event_update.set()
-
-            backlight.set_all(*BACKLIGHT_OFF)
-            backlight.show()
+            self._backlight_off()
 
-            lcd.clear()
-            lcd.show()
+            self._pages.close()
+            self._pages.show_overlay('blank')
+            self._compositor.flush()
 
             for ch in range(6):
                 touch.set_led(ch, 0)
 
 
-if __name__ == '__main__':
-    MPC().start()
+    def start(self):
+        asyncio.run(self.run())
+
 
+if __name__ == '__main__':
+    display = GfxHatDisplay()
+    if os.environ.get('GFXMPC_SHM'):
+        display = MultiDisplay(display, SharedMemoryDisplay(os.environ['GFXMPC_SHM']))
+    MPC(display, host=os.environ.get('MPD_HOST', MPD_SOCKET), port=int(os.environ.get('MPD_PORT', MPD_PORT)),
+        metrics_path=os.environ.get('GFXMPC_METRICS_SOCKET'), fifo_path=os.environ.get('GFXMPC_FIFO'),
+        lyrics=bool(os.environ.get('GFXMPC_LYRICS')), music_dir=os.environ.get('GFXMPC_MUSIC_DIR')).start()
@@ -3,5 +3,6 @@
 mkdir -p /opt/gfx-mpc
 cp gfxmpc.py /opt/gfx-mpc
 cp unifont-14.0.01.pcf /opt/gfx-mpc
+(cd /opt/gfx-mpc && python3 -c 'import gfxmpc; gfxmpc.GlyphAtlas.open(gfxmpc.FONT_PATH, gfxmpc.ATLAS_PATH)')
 cp gfx-mpc.service /lib/systemd/system
 systemctl enable gfx-mpc
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+
+import gfxmpc
+import bench
+import argparse
+import asyncio
+import bisect
+import json
+import math
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+SETTLE = 1
+WARMUP = 0.1
+MIN_SAMPLES = 8
+
+
+class ScaledLoop(asyncio.SelectorEventLoop):
+    # An event loop whose clock runs speed times faster than real time:
+    # every timeout handed to select() shrinks by the same factor. With
+    # speed 0 the clock skips straight to the next timer whenever nothing
+    # is ready to run.
+    def __init__(self, speed):
+        super().__init__()
+        self._speed = speed
+        self._origin = time.monotonic()
+        self._skipped = 0.0
+        select = self._selector.select
+
+        def scaled(timeout=None):
+            if timeout is None or timeout <= 0:
+                return select(timeout)
+            if speed:
+                return select(timeout / speed)
+            events = select(0)
+            if not events:
+                self._skipped += timeout
+            return events
+        self._selector.select = scaled
+
+    def time(self):
+        return self._origin + (time.monotonic() - self._origin) * (self._speed or 1) + self._skipped
+
+
+def synthetic_trace(hours, songs, seed):
+    # Listening with the odd interruption every few minutes: pauses, seeks,
+    # volume changes, skips, and another client swapping a queued song.
+    rng = random.Random(seed)
+    events = [(0.5, 'play', ['0'])]
+    t = 0.5
+    end = hours * 3600
+    while True:
+        t += rng.expovariate(1 / 300)
+        if t >= end:
+            break
+        kind = rng.random()
+        if kind < 0.3:
+            events.append((t, 'pause', []))
+            t += rng.uniform(5, 600)
+            events.append((t, 'pause', []))
+        elif kind < 0.5:
+            events.append((t, 'seekcur', ['%+d' % rng.choice((-30, -10, 10, 30, 60))]))
+        elif kind < 0.7:
+            events.append((t, 'volume', ['%+d' % rng.choice((-5, 5))]))
+        elif kind < 0.85:
+            events.append((t, 'next', []))
+        elif kind < 0.9:
+            events.append((t, 'previous', []))
+        else:
+            events.append((t, 'delete', [str(rng.randrange(songs))]))
+            i = rng.randrange(songs)
+            events.append((t, 'add', ['Artist %d/Album %d/%02d.flac' % (i // 20, i // 10, i % 10 + 1)]))
+    events.append((end, 'ping', []))
+    return events
+
+
+def write_lyrics(music_dir, songs, rng):
+    # A line every few seconds through each song, some with an offset tag
+    # or a chorus line carrying several timestamps.
+    for song in songs:
+        path = os.path.join(music_dir, os.path.splitext(song['file'])[0] + '.lrc')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        lines = []
+        if rng.random() < 0.2:
+            lines.append('[offset:%+d]' % rng.randrange(-500, 500))
+        t = rng.uniform(0, 20)
+        n = 0
+        while t < float(song['duration']):
+            lines.append('[%02d:%05.2f]Line %d' % (t // 60, t % 60, n))
+            t += rng.uniform(1, 8)
+            n += 1
+        if n > 4 and rng.random() < 0.3:
+            lines.append('[%02d:%05.2f][%02d:%05.2f]Chorus' % (t // 120, t / 2 % 60, t // 180, t / 3 % 60))
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+def load_trace(path):
+    with open(path) as f:
+        return [(e['t'], e['command'], e.get('args', [])) for e in map(json.loads, f) if e]
+
+
+def save_trace(path, events):
+    with open(path, 'w') as f:
+        for t, command, args in events:
+            f.write(json.dumps({'t': t, 'command': command, 'args': args}) + '\n')
+
+
+async def drive(mpd, events):
+    # Plays the trace against the fake server, moving on to the next song
+    # whenever one ends between two events.
+    loop = asyncio.get_running_loop()
+    t0 = loop.time()
+    for t, command, args in events:
+        while True:
+            now = loop.time() - t0
+            if mpd.state == 'play':
+                end = now + float(mpd.songs[mpd.pos]['duration']) - mpd.elapsed()
+                if end < t:
+                    await asyncio.sleep(max(end - now, 0))
+                    mpd.play(mpd.pos + 1)
+                    continue
+            await asyncio.sleep(max(t - now, 0))
+            break
+        try:
+            mpd.execute(command, args)
+        except LookupError:
+            pass
+
+
+def displayed_elapsed(widget):
+    return widget._min_10 * 600 + widget._min_1 * 60 + widget._sec_10 * 10 + widget._sec_1
+
+
+async def check_drift(mpc, mpd, interval, tolerance, changes, drift, t0):
+    # The elapsed digits show the whole seconds played, so they trail
+    # status elapsed by up to a second, or by up to LOW_POWER_INTERVAL more
+    # while the backlight is off. The progress bar may trail by the same
+    # time in pixels. Timers may run TIMER_SLACK early; tolerance covers
+    # the status round trip, which the scaled clock stretches too.
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        if mpd.state != 'play' or mpc._state != 'play' or loop.time() - changes[0] < SETTLE:
+            continue
+        song = mpd.songs[mpd.pos]
+        if mpc._current_songid != song['Id']:
+            continue
+        expected = mpd.elapsed()
+        lead = gfxmpc.TIMER_SLACK + tolerance
+        lag = 1 + lead + (gfxmpc.LOW_POWER_INTERVAL if mpc._low_power else 0)
+        d = displayed_elapsed(mpc._time_elapsed) - expected
+        step = float(song['duration']) / (gfxmpc.WIDTH - 2)
+        p = mpc._progress_bar._progress - int(expected / step)
+        drift['checks'] += 1
+        drift['max_s'] = max(drift['max_s'], abs(d))
+        drift['max_px'] = max(drift['max_px'], abs(p))
+        ok = -lag <= d <= lead and -math.ceil(lag / step) - 1 <= p <= 1
+        times, lines = mpc._lyrics
+        if times:
+            # The line shown may be any one due between lag ago and lead
+            # from now, and the album line must hold its text.
+            drift['lyric_checks'] += 1
+            lo = bisect.bisect_right(times, expected - lag) - 1
+            hi = bisect.bisect_right(times, expected + lead) - 1
+            shown = lines[mpc._lyric] if mpc._lyric >= 0 else song.get('Album')
+            ok = ok and lo <= mpc._lyric <= hi and mpc._text_info[2]._text == shown
+        if not ok:
+            drift['violations'] += 1
+            if len(drift['examples']) < 10:
+                drift['examples'].append({'t': loop.time() - t0, 'elapsed_s': expected, 'drift_s': d, 'drift_px': p, 'lyric': mpc._lyric,
+                        'low_power': mpc._low_power})
+
+
+async def sample(mpc, interval, samples):
+    # The default executor starts workers as jobs overlap, up to its
+    # bound, so they are counted apart from any other thread.
+    loop = asyncio.get_running_loop()
+    t0 = loop.time()
+    while True:
+        executor = loop._default_executor
+        workers = len(executor._threads) if executor is not None else 0
+        samples.append({
+                't_hours': (loop.time() - t0) / 3600,
+                'rss_kb': bench.rss_kb(),
+                'threads': threading.active_count() - workers,
+                'executor_threads': workers,
+                'scheduler_heap': len(mpc._scheduler._heap),
+                'loop_timers': len(loop._scheduled),
+                'tasks': len(asyncio.all_tasks()),
+                'commands': len(mpc._commands)
+        })
+        await asyncio.sleep(interval)
+
+
+def flat(samples, key, slack=0):
+    # After the warm-up, the second half may not settle above anything
+    # seen in the first. Its median, so a timer that happens to be pending
+    # at one sample is not taken for a leak; runs with fewer than
+    # MIN_SAMPLES samples left are too short to tell.
+    samples = samples[max(int(len(samples) * WARMUP), 1):]
+    half = len(samples) // 2
+    if len(samples) < MIN_SAMPLES:
+        return True
+    return statistics.median(s[key] for s in samples[half:]) <= max(s[key] for s in samples[:half]) + slack
+
+
+async def replay(args, events, atlas, tmp):
+    loop = asyncio.get_running_loop()
+    gfxmpc.lcd = bench.StubLCD()
+    gfxmpc.backlight = bench.StubBacklight()
+    gfxmpc.touch = bench.StubTouch()
+
+    rng = random.Random(args.seed)
+    library = bench.make_songs(args.songs, 0)
+    for song in library:
+        song['duration'] = '%.3f' % rng.uniform(120, 480)
+    music_dir = None
+    if args.lyrics:
+        music_dir = os.path.join(tmp, 'music')
+        write_lyrics(music_dir, library, rng)
+    mpd = bench.FakeMPD(library, args.songs, clock=loop.time)
+    t0 = loop.time()
+    changes = [t0]
+    changed = mpd.changed
+
+    def record_change(*subsystems):
+        changes[0] = loop.time()
+        changed(*subsystems)
+    mpd.changed = record_change
+
+    path = os.path.join(tmp, 'mpd.socket')
+    server = await asyncio.start_unix_server(mpd.handle, path)
+    mpc = gfxmpc.MPC(gfxmpc.HeadlessDisplay(), host=path, font_path=args.font, atlas_path=atlas, art_cache_dir=os.path.join(tmp, 'art'),
+            library_path=os.path.join(tmp, 'library.index'), history_path=os.path.join(tmp, 'history.db'),
+            lyrics=args.lyrics, music_dir=music_dir, clock=loop.time)
+    task = asyncio.create_task(mpc.run())
+
+    drift = {'checks': 0, 'lyric_checks': 0, 'violations': 0, 'max_s': 0.0, 'max_px': 0, 'examples': []}
+    samples = []
+    t_real = time.monotonic()
+    t_cpu = time.process_time()
+    checks = [
+            asyncio.create_task(check_drift(mpc, mpd, args.check_interval, args.tolerance, changes, drift, t0)),
+            asyncio.create_task(sample(mpc, args.sample_interval, samples))
+    ]
+    await drive(mpd, events)
+    real = time.monotonic() - t_real
+    cpu = time.process_time() - t_cpu
+    for check in checks:
+        check.cancel()
+    task.cancel()
+    await task
+    while mpd._clients:
+        await asyncio.sleep(0.01)
+    server.close()
+    await server.wait_closed()
+
+    virtual = events[-1][0]
+    result = {
+            'virtual_hours': virtual / 3600,
+            'real_seconds': real,
+            'speed': virtual / real,
+            'cpu_seconds_per_virtual_hour': cpu / virtual * 3600,
+            'events': len(events),
+            'track_changes': sum(sum(counts) for counts in gfxmpc.metrics.track_change._counts.values()),
+            'drift': drift,
+            'samples': samples,
+            'passed': {
+                    'drift': drift['violations'] == 0 and drift['checks'] > 0 and (drift['lyric_checks'] > 0 or not args.lyrics),
+                    'rss': flat(samples, 'rss_kb', args.rss_slack),
+                    'threads': flat(samples, 'threads'),
+                    # One-shot timers and tasks come and go, so one more
+                    # than ever seen before is still flat.
+                    'queues': all(flat(samples, key, 1) for key in ('scheduler_heap', 'loop_timers', 'tasks', 'commands'))
+            }
+    }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay an MPD trace against gfxmpc on an accelerated clock and check for drift and leaks.')
+    parser.add_argument('--hours', type=float, default=24, help='length of the synthetic trace')
+    parser.add_argument('--speed', type=float, default=100, help='clock speed-up; 0 skips idle time entirely')
+    parser.add_argument('--trace', help='replay this JSON lines trace instead of a synthetic one')
+    parser.add_argument('--save-trace', help='write the trace being replayed here')
+    parser.add_argument('--songs', type=int, default=200, help='length of the fake queue')
+    parser.add_argument('--seed', type=int, default=1, help='seed for the synthetic trace and song lengths')
+    parser.add_argument('--lyrics', action='store_true', help='give every song an LRC file and check the lyric line too')
+    parser.add_argument('--check-interval', type=float, default=1, help='virtual seconds between drift checks')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='virtual seconds the display may be off beyond the timer slack')
+    parser.add_argument('--sample-interval', type=float, default=600, help='virtual seconds between RSS, thread and queue samples')
+    parser.add_argument('--rss-slack', type=int, default=1024, help='RSS growth in KiB still counted as flat')
+    parser.add_argument('--font', default=gfxmpc.FONT_PATH, help='font used for the text lines')
+    parser.add_argument('--atlas', help='glyph atlas to use; a fresh one is built in a temporary directory by default')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    if args.trace:
+        events = load_trace(args.trace)
+    else:
+        events = synthetic_trace(args.hours, args.songs, args.seed)
+    if args.save_trace:
+        save_trace(args.save_trace, events)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        atlas = args.atlas or os.path.join(tmp, 'font.atlas')
+        gfxmpc.GlyphAtlas.open(args.font, atlas)
+        loop = ScaledLoop(args.speed)
+        try:
+            result = loop.run_until_complete(replay(args, events, atlas, tmp))
+        finally:
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                loop.run_until_complete(asyncio.wait(tasks))
+            loop.close()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    sys.exit(0 if all(result['passed'].values()) else 1)
+
+
+if __name__ == '__main__':
+    main()